@@ -576,6 +576,29 @@ class VisitCondAdmin(AbstractAdmin):
     search_fields = _search_name
     raw_id_fields = ('areas', 'zips', 'bricks')
 
+    def save_related(self, request, form, formsets, change):
+        super(VisitCondAdmin, self).save_related(request, form, formsets, change)
+        form.instance.builder._generate_check() # generated builders, incremental re-generation.
+
+    def delete_model(self, request, obj):
+        super(VisitCondAdmin, self).delete_model(request, obj)
+        obj.builder._generate_check()
+
+    def get_actions(self, request):
+        # the bulk delete_selected does NOT call delete_model, same re-generation once deleted.
+        actions = super(VisitCondAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            fn, name, description = actions['delete_selected']
+            def delete_selected(modeladmin, request, queryset):
+                builders = set([ cond.builder for cond in queryset ])
+                response = fn(modeladmin, request, queryset)
+                if response is None: # deleted, otherwise the confirmation page.
+                    for builder in builders:
+                        builder._generate_check()
+                return response
+            actions['delete_selected'] = (delete_selected, name, description)
+        return actions
+
 _admin(VisitCond, VisitCondAdmin)
 
 
@@ -623,6 +646,27 @@ _admin(VisitBuilder, VisitBuilderAdmin)
 
 
 
+class BuilderJobAdmin(AbstractAdmin):
+
+    list_display = _fields + ('builder', 'status', 'queued', 'started', 'finished', 'error')
+    list_display_links = _fields
+    list_filter = ('status',)
+    search_fields = _search + ('builder__name',)
+    readonly_fields = ('builder', 'status')
+    actions = ('reset',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def reset(self, request, queryset):
+        for job in queryset:
+            job.reset('Reset @ admin.')
+    reset.short_description = 'Reset pending jobs (e.g. dead worker), partial visits undone.'
+
+_admin(BuilderJob, BuilderJobAdmin)
+
+
+
 class OnOffPeriodAdmin(AbstractAdmin):
 
     list_display = _fields + ('on', 'start', 'end', 'visited_user', 'visited_loc', 'visit_user')
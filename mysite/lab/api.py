@@ -1,8 +1,17 @@
 from rest_framework import viewsets, serializers, routers
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import ParseError
+from rest_framework.templatetags.rest_framework import replace_query_param
+from rest_framework.utils.encoders import JSONEncoder
 import django_filters # http://www.django-rest-framework.org/api-guide/filtering#djangofilterbackend
 
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+import base64
+import csv
+import json
+
 from .models import *
 from . import admin
 import utils
@@ -74,6 +83,57 @@ def _id_url(source, many=False):
 def _ids_urls(*args, **kwargs):
     return _id_url(many=True, *args, **kwargs)
 
+def _related(fields):
+    # relations of the _id_url / _ids_urls fields being serialized, to be loaded with the rows instead of one query per row & field:
+    # select_related (one, hyperlinks only, ids are read from the row) & prefetch_related (many).
+    ones, manys = [], []
+    for name, field in fields.items():
+        if isinstance(field, (GoRelatedField, serializers.HyperlinkedRelatedField)):
+            source = field.source or name
+            if field.many:
+                manys.append(source)
+            elif not isinstance(field, GoRelatedField):
+                ones.append(source)
+    return sorted(set(ones)), sorted(set(manys))
+
+def _cursor_encode(values):
+    # full precision isoformat (NOT DjangoJSONEncoder, which truncates microseconds).
+    return base64.urlsafe_b64encode(json.dumps([ v.isoformat() if hasattr(v, 'isoformat') else v for v in values ]))
+
+def _cursor_decode(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ParseError('Invalid cursor.')
+
+def _cursor_q(keys, values):
+    # rows after values @ keys order, e.g. (datetime, id): datetime > v1 OR (datetime = v1 AND id > v2).
+    q = Q()
+    for i, k in enumerate(keys):
+        q |= Q(**dict(zip(keys[:i], values[:i]) + [ ('%s__gt' % k, values[i]) ]))
+    return q
+
+def _keyset(qset, keys, size):
+    # ALL rows @ keys order, read in chunks of size (each from where the previous one ended), one at a time.
+    qset = qset.order_by(*keys)
+    values = None
+    while True:
+        chunk = qset.filter(_cursor_q(keys, values)) if values else qset
+        n = 0
+        for row in chunk[:size].iterator():
+            n += 1
+            yield row
+        if n < size:
+            break
+        values = [ getattr(row, k) for k in keys ]
+
+class _Echo(object):
+
+    # csv.writer target, returning each line instead of buffering it.
+
+    def write(self, value):
+        return value
+
 _fields = ('url', 'id', 'syscode')
 
 _fields_name = _fields + ('name',)
@@ -102,7 +162,36 @@ class AbstractSerializer(serializers.HyperlinkedModelSerializer):
         return super(AbstractSerializer, self).from_native(data, files)
     '''
 
-    pass
+    def __init__(self, *args, **kwargs):
+        super(AbstractSerializer, self).__init__(*args, **kwargs)
+        # sparse fieldsets, fields NOT requested are removed, so NOT computed (nor their relations loaded, see _related):
+        # ?fields=id,name (only those), ?omit=rec (all but those), ?links=0 (ids only, NO url / *__url / *__urls hyperlinks)
+        # & ?expand=group (expensive fields @ Meta.expand groups, left out by default).
+        request = self.context.get('request')
+        if request:
+            params = request.QUERY_PARAMS
+            fields = utils.str_list(params.get('fields'))
+            omit = utils.str_list(params.get('omit'))
+            links = utils.str_int(params.get('links')) != 0
+            expand = utils.str_list(params.get('expand'))
+            groups = getattr(self.Meta, 'expand', dict())
+            grouped = utils.list_flatten(groups.values(), list)
+            expanded = utils.list_flatten([ name for name in expand if name in groups ], lambda name: groups[name])
+            for name in self.fields.keys():
+                keep = name in fields if fields else name not in grouped
+                if not links and (name == 'url' or name.endswith(('__url', '__urls'))):
+                    keep = False
+                if name in omit or not (keep or name in expanded):
+                    self.fields.pop(name)
+
+    def _rows(self, row):
+        # rows being serialized with this row (e.g. the page), for fields computed at once for all of them.
+        view = self.context.get('view')
+        rows = getattr(view, '_rows', None)
+        if rows is None:
+            rows = getattr(view, 'object_list', None)
+        rows = list(rows) if rows is not None else []
+        return rows if row in rows else [ row ]
 
 class AbstractTreeSerializer(AbstractSerializer):
 
@@ -159,9 +248,75 @@ class AbstractView(viewsets.ModelViewSet):
         # print 'get_object', self, queryset, v
         return v
 
+    cursor_keys = ('id',) # keyset pagination (?cursor=), unique together & indexed.
+
+    def list(self, request, *args, **kwargs):
+        # ?cursor= (empty for the first page) instead of ?page=: each page is read from where the previous one ended,
+        # NO offset & NO count (unless ?count=1), constant cost however deep, e.g. exports.
+        if 'cursor' not in request.QUERY_PARAMS:
+            return super(AbstractView, self).list(request, *args, **kwargs)
+        params = request.QUERY_PARAMS
+        keys = self.cursor_keys
+        size = self.get_paginate_by()
+        self.object_list = self.filter_queryset(self.get_queryset())
+        qset = self.object_list.order_by(*keys)
+        cursor = params.get('cursor')
+        if cursor:
+            values = _cursor_decode(cursor)
+            if len(values) != len(keys):
+                raise ParseError('Invalid cursor.')
+            qset = qset.filter(_cursor_q(keys, values))
+        rows = list(qset[:size + 1])
+        more = len(rows) > size
+        self._rows = rows = rows[:size]
+        data = dict(next=None)
+        if more:
+            last = rows[-1]
+            data['next'] = replace_query_param(request.build_absolute_uri(), 'cursor', _cursor_encode([ getattr(last, k) for k in keys ]))
+        if utils.str_int(params.get('count')):
+            data['count'] = self.object_list.count()
+        data['results'] = self.get_serializer(rows, many=True).data
+        return Response(data)
+
+    export_chunk = 1000 # rows read per query @ export.
+
+    def _export(self, request):
+        # streamed (NOT buffered) NDJSON (default) or CSV (?as=csv) of ALL the filtered rows, @ cursor_keys order,
+        # serialized one at a time, so memory stays the same however many rows, e.g. mobile & BI syncs.
+        rows = _keyset(self.filter_queryset(self.get_queryset()), self.cursor_keys, self.export_chunk)
+        serializer = self.get_serializer()
+        fmt = 'csv' if request.QUERY_PARAMS.get('as') == 'csv' else 'ndjson'
+        if fmt == 'csv':
+            writer = csv.writer(_Echo())
+            names = serializer.fields.keys()
+            def _cell(v):
+                if isinstance(v, (list, dict)):
+                    v = json.dumps(v, cls=JSONEncoder)
+                return unicode('' if v is None else v).encode('utf-8')
+            def _lines():
+                yield writer.writerow(names)
+                for row in rows:
+                    d = serializer.to_native(row)
+                    yield writer.writerow([ _cell(d.get(name)) for name in names ])
+            response = StreamingHttpResponse(_lines(), content_type='text/csv; charset=utf-8')
+        else:
+            response = StreamingHttpResponse(('%s\n' % json.dumps(serializer.to_native(row), cls=JSONEncoder) for row in rows), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (serializer.opts.model._meta.model_name, fmt)
+        return response
+
+    def paginate_queryset(self, *args, **kwargs):
+        page = super(AbstractView, self).paginate_queryset(*args, **kwargs)
+        self._rows = page.object_list if page is not None else None # @ AbstractSerializer._rows.
+        return page
+
     # http://www.django-rest-framework.org/api-guide/filtering
     def get_queryset(self):
         qset = super(AbstractView, self).get_queryset()
+        ones, manys = _related(self.get_serializer().fields)
+        if ones: # NOT empty, otherwise ALL relations.
+            qset = qset.select_related(*ones)
+        if manys:
+            qset = qset.prefetch_related(*manys)
         for name, deep in [ ('incats', True), ('cats', False) ]:
             cats = self.request.QUERY_PARAMS.get(name)
             if cats:
@@ -172,12 +327,17 @@ class AbstractView(viewsets.ModelViewSet):
                     if cats:
                         if deep:
                             target = field.related.parent_model
-                            cats = utils.list_compact([ utils.db_get(target, cat) for cat in cats ])
-                            cats = utils.tree_all_downs(cats)
+                            cats = utils.tree_all_downs(target.objects.filter(id__in=cats))
                         qset = qset.filter(cats__in=cats)
                         # print 'get_queryset', self, type(qset), model, cats
         return qset
 
+class AbstractExportView(AbstractView):
+
+    @list_route()
+    def export(self, request):
+        return self._export(request)
+
 class AbstractTreeView(AbstractView):
 
     @list_route()
@@ -656,8 +816,8 @@ class ForceVisitSerializer(AbstractSerializer):
     loc, loc__url = _id_url('loc')
     builder, builder__url = _id_url('builder')
 
-    get_prep_public = serializers.Field()
-    get_prep_private = serializers.Field()
+    get_prep_public = serializers.SerializerMethodField('prep_public')
+    get_prep_private = serializers.SerializerMethodField('prep_private')
 
     class Meta:
         model = model
@@ -673,6 +833,21 @@ class ForceVisitSerializer(AbstractSerializer):
             'f_contact', 'f_goal', 'f_option',
             'get_prep_public', 'get_prep_private',
         )
+        expand = dict(prep=('get_prep_public', 'get_prep_private')) # opt-in, ?expand=prep.
+
+    def _prep(self, visit, private):
+        # forms of all the page visits at once, instead of per visit.
+        reps = self.__dict__.setdefault('_reps', dict())
+        if (visit.id, private) not in reps:
+            for eid, erep in Form.get_forms_reps_many(self._rows(visit), private).items():
+                reps[(eid, private)] = erep
+        return visit._get_prep(private, reps=reps[(visit.id, private)])
+
+    def prep_public(self, visit):
+        return self._prep(visit, False)
+
+    def prep_private(self, visit):
+        return self._prep(visit, True)
 
 class ForceVisitFilter(AbstractFilter):
 
@@ -683,12 +858,19 @@ class ForceVisitFilter(AbstractFilter):
         model = model
         fields = search + ('starts', 'ends', 'node', 'loc', 'status', 'accompanied') # 'observations', 'rec'
 
-class ForceVisitViewSet(AbstractView):
+class ForceVisitViewSet(AbstractExportView):
 
     queryset = _all(model)
     serializer_class = ForceVisitSerializer
     search_fields = search
     filter_class = ForceVisitFilter
+    cursor_keys = ('datetime', 'id')
+
+    def get_queryset(self):
+        qset = super(ForceVisitViewSet, self).get_queryset()
+        if set(ForceVisitSerializer.Meta.expand['prep']) & set(self.get_serializer().fields):
+            qset = ForceVisit.prep_queryset(qset) # requested get_prep_*.
+        return qset
 
 _api('forcevisits', ForceVisitViewSet)
 
@@ -766,11 +948,14 @@ class UserFormRecSerializer(AbstractSerializer):
 
 class UserFormRecFilter(AbstractFilter):
 
+    starts = _filter_start('datetime')
+    ends = _filter_end('datetime')
+
     class Meta:
         model = model
-        fields = search # + ('observations', 'rec')
+        fields = search + ('starts', 'ends', 'user', 'form') # + ('observations', 'rec')
 
-class UserFormRecViewSet(AbstractView):
+class UserFormRecViewSet(AbstractExportView):
 
     queryset = _all(model)
     serializer_class = UserFormRecSerializer
@@ -1219,7 +1404,19 @@ class VisitBuilderViewSet(AbstractView):
         return Response('Delete NOT Allowed', status=405)
 
     def post_save(self, obj, created):
-        obj._generate_check()
+        obj._generate_check() # queued, see status below.
+
+    @detail_route()
+    def status(self, request, pk=None):
+        return Response(self.get_object().status())
+
+    @detail_route()
+    def simulate(self, request, pk=None):
+        return Response(self.get_object().simulate())
+
+    @detail_route()
+    def capacity(self, request, pk=None):
+        return Response(self.get_object().capacity())
 
 _api('visitbuilders', VisitBuilderViewSet)
 
@@ -1275,6 +1472,12 @@ class VisitCondViewSet(AbstractView):
     search_fields = search
     filter_class = VisitCondFilter
 
+    def post_save(self, obj, created):
+        obj.builder._generate_check() # generated builders, incremental re-generation.
+
+    def post_delete(self, obj):
+        obj.builder._generate_check()
+
 _api('visitconds', VisitCondViewSet)
 
 
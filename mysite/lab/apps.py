@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+class LabConfig(AppConfig):
+
+    name = 'lab'
+
+    def ready(self):
+        from django.core.signals import request_started, request_finished
+        from . import utils
+        utils.on_commit_install() # first, NO atomic block entered yet.
+        request_started.connect(utils.versions_begin, dispatch_uid='lab.utils.versions_begin')
+        request_finished.connect(utils.versions_end, dispatch_uid='lab.utils.versions_end')
+        from . import availability, eligibility, nodes, payloads, trees # signals.
@@ -0,0 +1,144 @@
+from django.db.models.signals import post_save, post_delete
+
+from bisect import bisect_right
+from collections import defaultdict
+
+from .models import *
+
+import utils
+
+'''
+Precompiled availability calendars, for users (visit) and locs (visited).
+The WeekConfig / DayConfig / TimeConfig chain plus the OnOffPeriod / OnOffTime overrides are compiled into
+sorted segments, so each check is a few binary searches instead of queries + sorts.
+Compiled calendars are cached per process, and dropped when the shared version (cache backend) changes,
+which is bumped by the signals below whenever any of the source rows change.
+'''
+
+class Segments(object):
+
+    # sorted disjoint segments => value, from inclusive (start, end, value) ranges, given in priority order:
+    # the latest start wins, on ties the later range (same as sorted by start & last @ VisitBuilder).
+
+    def __init__(self, ranges):
+        self.keys = sorted(set(utils.list_flatten(ranges, lambda r: [ (r[0], 0), (r[1], 1) ])))
+        self.values = []
+        for key in self.keys:
+            v = vstart = None
+            for start, end, value in ranges:
+                if (start, 0) <= key < (end, 1) and (vstart is None or start >= vstart):
+                    v, vstart = value, start
+            self.values.append(v)
+
+    def get(self, x):
+        i = bisect_right(self.keys, (x, 0)) - 1
+        return self.values[i] if i >= 0 else None
+
+
+
+class Calendar(object):
+
+    # week id => (day id @ utils.weekdays), day id => [ (start, end) ] @ TimeConfig ordering & compiled Segments.
+
+    def __init__(self):
+        self.weeks = dict([ (week.id, tuple([ getattr(week, '%s_id' % day) for day in utils.weekdays ]))
+            for week in WeekConfig.objects.all() ])
+        self.times = defaultdict(list)
+        for etime in TimeConfig.objects.all():
+            self.times[etime.day_id].append((etime.start, etime.end))
+        self.segments = dict([ (dayid, Segments([ (start, end, True) for start, end in times ]))
+            for dayid, times in self.times.items() ])
+
+    def day(self, weekid, date):
+        return self.weeks[weekid][date.weekday()]
+
+    def day_times(self, dayid):
+        return self.times.get(dayid) or []
+
+    def intime(self, weekid, dt):
+        dayid = self.day(weekid, dt)
+        return bool(dayid and dayid in self.segments and self.segments[dayid].get(dt.time()))
+
+
+
+class Availability(object):
+
+    # ONE user (visit) or loc (visited): week id & on/off overrides of all its sources (e.g. loc, then loc.user).
+
+    def __init__(self, weekid, periods, times):
+        self.weekid = weekid
+        self.periods = Segments([ (e.start, e.end, e.on) for e in periods ])
+        self.times = dict()
+        for date in set([ None ] + [ e.date for e in times ]):
+            self.times[date] = Segments([ (e.start, e.end, e.on) for e in times if not e.date or e.date == date ])
+
+    def day_off(self, calendar, date):
+        # unavailable for the whole date (no day config / times, or an off period), regardless of time overrides.
+        dayid = calendar.day(self.weekid, date)
+        return not (dayid and calendar.day_times(dayid)) or self.periods.get(date) is False
+
+    def ison(self, calendar, dt):
+        if calendar.intime(self.weekid, dt):
+            dtdate = dt.date()
+            if self.periods.get(dtdate) is not False:
+                times = self.times.get(dtdate) or self.times[None]
+                return times.get(dt.time()) is not False
+        return False
+
+
+
+_cached = utils.Versioned('lab.availability.version') # calendar & els.
+
+def invalidate(**kwargs):
+    _cached.invalidate()
+
+for _model in [ WeekConfig, DayConfig, TimeConfig, OnOffPeriod, OnOffTime, Loc, User, Sys ]:
+    post_save.connect(invalidate, sender=_model, dispatch_uid='lab.availability.%s.save' % _model.__name__)
+    post_delete.connect(invalidate, sender=_model, dispatch_uid='lab.availability.%s.delete' % _model.__name__)
+
+def calendar():
+    data = _cached.get()
+    if 'calendar' not in data:
+        data['calendar'] = Calendar()
+    return data['calendar']
+
+def _load(model, fname, ids):
+    d = defaultdict(list)
+    if ids:
+        for row in model.objects.filter(**{'%s__in' % fname: ids}):
+            d[getattr(row, '%s_id' % fname)].append(row)
+    return d
+
+def user_visit(user, sys):
+    # the user (if any) visiting, e.g. ForceNode.user.
+    els = _cached.get().setdefault('els', dict())
+    k = ('visit_user', user.id if user else None)
+    if k not in els:
+        ids = [ user.id ] if user else []
+        els[k] = Availability(
+            (user.week_visit_id if user else None) or sys.week_user_visit_id,
+            _load(OnOffPeriod, 'visit_user', ids).get(k[1], []),
+            _load(OnOffTime, 'visit_user', ids).get(k[1], []),
+        )
+    return els[k]
+
+def locs_visited(locs, sys):
+    # loc.id => Availability, for the locs being visited (loc.user must be loaded, e.g. select_related).
+    els = _cached.get().setdefault('els', dict())
+    missing = [ loc for loc in locs if ('visited_loc', loc.id) not in els ]
+    if missing:
+        locids = [ loc.id for loc in missing ]
+        userids = list(set([ loc.user_id for loc in missing ]))
+        rows = dict()
+        for model in [ OnOffPeriod, OnOffTime ]:
+            rows[model] = (_load(model, 'visited_loc', locids), _load(model, 'visited_user', userids))
+        def _rows(model, loc):
+            bylocs, byusers = rows[model]
+            return bylocs.get(loc.id, []) + byusers.get(loc.user_id, [])
+        for loc in missing:
+            els[('visited_loc', loc.id)] = Availability(
+                loc.week_id or loc.user.week_visited_id or sys.week_user_visited_id,
+                _rows(OnOffPeriod, loc),
+                _rows(OnOffTime, loc),
+            )
+    return dict([ (loc.id, els[('visited_loc', loc.id)]) for loc in locs ])
@@ -0,0 +1,216 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from collections import defaultdict
+
+from .models import *
+from . import trees
+
+import utils
+
+'''
+Materialized form eligibility @ Form.get_forms_reps: usercat / loccat / itemcat / forcenode / brick => forms,
+with the ancestor closure @ lab.trees (a form of a cat applies to all its sub cats), so resolving is a few set unions
+instead of ancestor & m2m queries per form.
+Same for rep items: visit usercat / loccat => visible items, and per form its rep items / usercats.
+Cached per process, patched in place on Form / tree changes (once committed), and dropped when the shared version changes
+(i.e. changed by another process).
+'''
+
+_dims = [
+    # scope, Form m2m, tree model (None if NOT a tree).
+    ('users', 'users_usercats', UserCat),
+    ('users', 'users_loccats', LocCat),
+    ('visits', 'visits_usercats', UserCat),
+    ('visits', 'visits_loccats', LocCat),
+    ('visits', 'visits_itemcats', ItemCat),
+    ('visits', 'visits_forcenodes', ForceNode),
+    ('visits', 'visits_bricks', None),
+]
+
+_trees = dict([ (fname, model) for scope, fname, model in _dims ])
+
+_items_trees = dict(visits_usercats=UserCat, visits_loccats=LocCat) # Item m2m => tree model, rep items visibility.
+
+def _rel_fname(model, fname):
+    # e.g. visits_usercats => usercat_id, @ the auto through model.
+    return '%s_id' % model._meta.get_field(fname).m2m_reverse_field_name()
+
+def _closure(memo, k, rels, model, relid):
+    # ids related to relid or any of its ancestors.
+    v = memo.get(k)
+    if v is None:
+        v = set()
+        for eid in (trees.get(model).ups.get(relid, ()) if model else [ relid ]):
+            v |= rels.get(eid, set())
+        memo[k] = v
+    return v
+
+class FormIndex(object):
+
+    def __init__(self):
+        self.forms = dict() # form id => (scope, private).
+        self.rels = dict([ (fname, defaultdict(set)) for fname in _trees ]) # m2m => rel id => form ids.
+        self.closed = dict() # (m2m, rel id) => form ids, ancestors included.
+        self.items_rels = dict([ (fname, defaultdict(set)) for fname in _items_trees ]) # Item m2m => rel id => item ids.
+        self.items_closed = dict() # (m2m, rel id) => item ids, ancestors included.
+        self.reps = dict() # form id => rep items (repitems & repitemcats items), name order.
+        self.reps_usercats = dict() # form id => rep usercats, descendants included.
+        self._load_forms()
+        self._load_items()
+
+    def _load_forms(self, formid=None):
+        forms = Form.objects.all()
+        if formid:
+            forms = forms.filter(id=formid)
+        for eid, scope, private in forms.values_list('id', 'scope', 'private'):
+            self.forms[eid] = (scope, private)
+        for fname in _trees:
+            rows = getattr(Form, fname).through.objects.all()
+            if formid:
+                rows = rows.filter(form_id=formid)
+            for eid, relid in rows.values_list('form_id', _rel_fname(Form, fname)):
+                self.rels[fname][relid].add(eid)
+
+    def _load_items(self, itemids=None):
+        for fname in _items_trees:
+            rows = getattr(Item, fname).through.objects.all()
+            if itemids is not None:
+                rows = rows.filter(item_id__in=itemids)
+            for eid, relid in rows.values_list('item_id', _rel_fname(Item, fname)):
+                self.items_rels[fname][relid].add(eid)
+
+    def update_form(self, formid):
+        self.forms.pop(formid, None)
+        for rels in self.rels.values():
+            for formids in rels.values():
+                formids.discard(formid)
+        self._load_forms(formid)
+        self.closed = dict()
+        self.reps.pop(formid, None)
+        self.reps_usercats.pop(formid, None)
+
+    def update_items(self, itemids):
+        for rels in self.items_rels.values():
+            for eids in rels.values():
+                eids.difference_update(itemids)
+        self._load_items(itemids)
+        self.items_closed = dict()
+        self.reps = dict()
+
+    def update_tree(self, model):
+        # ancestors @ lab.trees, only the closures are dropped.
+        self.closed = dict([ (k, v) for k, v in self.closed.items() if _trees[k[0]] is not model ])
+        self.items_closed = dict([ (k, v) for k, v in self.items_closed.items() if _items_trees[k[0]] is not model ])
+        if model is ItemCat:
+            self.reps = dict()
+        if model is UserCat:
+            self.reps_usercats = dict()
+
+    def _closed(self, fname, relid):
+        return _closure(self.closed, (fname, relid), self.rels[fname], _trees[fname], relid)
+
+    def forms_ids(self, scope, private, **rels):
+        # rels: m2m => elements (or ids), e.g. visits_usercats=user.cats.all().
+        formids = set()
+        for fname, els in rels.items():
+            for each in els or []:
+                if each is not None:
+                    formids |= self._closed(fname, getattr(each, 'id', each))
+        return set([ eid for eid in formids if self.forms.get(eid) == (scope, private) ])
+
+    def items_visible(self, usercats, loccats):
+        # rep items visible @ a visit: any of its usercats / loccats (or their ancestors) @ the item visits_usercats / visits_loccats.
+        itemids = set()
+        for fname, els in [ ('visits_usercats', usercats), ('visits_loccats', loccats) ]:
+            for each in els or []:
+                relid = getattr(each, 'id', each)
+                itemids |= _closure(self.items_closed, (fname, relid), self.items_rels[fname], _items_trees[fname], relid)
+        return itemids
+
+    def form_reps(self, form):
+        v = self.reps.get(form.id)
+        if v is None:
+            reps1 = form.repitems.all()
+            repcats = utils.tree_all_downs(form.repitemcats.all())
+            reps2 = ItemCat.els_get(repcats)
+            v = self.reps[form.id] = list((reps1 | reps2).distinct())
+        return v
+
+    def form_reps_usercats(self, form):
+        v = self.reps_usercats.get(form.id)
+        if v is None:
+            v = self.reps_usercats[form.id] = utils.tree_all_downs(form.repusercats.all())
+        return v
+
+
+
+_cached = utils.Versioned('lab.eligibility.version') # index.
+
+def index():
+    data = _cached.get()
+    if 'index' not in data:
+        data['index'] = FormIndex()
+    return data['index']
+
+def _patch(fn):
+    # patch the local index in place (if built), other processes rebuild on the version change.
+    def _fn(data):
+        if 'index' in data:
+            fn(data['index'])
+    _cached.patch(_fn)
+
+def invalidate(**kwargs):
+    _cached.invalidate()
+
+def _form_changed(instance, **kwargs):
+    _patch(lambda index: index.update_form(instance.id))
+
+def _form_rels_changed(instance, action, reverse, pk_set, **kwargs):
+    if action in [ 'post_add', 'post_remove', 'post_clear' ]:
+        if not reverse:
+            _form_changed(instance)
+        elif pk_set is not None:
+            _patch(lambda index: [ index.update_form(formid) for formid in pk_set ])
+        else: # reverse clear, forms unknown.
+            invalidate()
+
+def _items_changed(itemids):
+    _patch(lambda index: index.update_items(set(itemids)))
+
+def _item_changed(instance, **kwargs):
+    _items_changed([ instance.id ])
+
+def _items_rels_changed(instance, action, reverse, pk_set, **kwargs):
+    if action in [ 'post_add', 'post_remove', 'post_clear' ]:
+        if not reverse:
+            _items_changed([ instance.id ])
+        elif pk_set is not None:
+            _items_changed(pk_set)
+        else: # reverse clear, items unknown.
+            invalidate()
+
+def _items_cats_changed(action, **kwargs):
+    if action in [ 'post_add', 'post_remove', 'post_clear' ]:
+        _patch(lambda index: index.reps.clear())
+
+def _tree_changed(sender, **kwargs):
+    _patch(lambda index: index.update_tree(sender))
+
+post_save.connect(_form_changed, sender=Form, dispatch_uid='lab.eligibility.Form.save')
+post_delete.connect(_form_changed, sender=Form, dispatch_uid='lab.eligibility.Form.delete')
+
+for _fname in _trees.keys() + [ 'repitems', 'repitemcats', 'repusercats' ]:
+    m2m_changed.connect(_form_rels_changed, sender=getattr(Form, _fname).through, dispatch_uid='lab.eligibility.Form.%s' % _fname)
+
+post_save.connect(_item_changed, sender=Item, dispatch_uid='lab.eligibility.Item.save')
+post_delete.connect(_item_changed, sender=Item, dispatch_uid='lab.eligibility.Item.delete')
+
+for _fname in _items_trees:
+    m2m_changed.connect(_items_rels_changed, sender=getattr(Item, _fname).through, dispatch_uid='lab.eligibility.Item.%s' % _fname)
+
+m2m_changed.connect(_items_cats_changed, sender=Item.cats.through, dispatch_uid='lab.eligibility.Item.cats')
+
+for _model in set(_trees.values()):
+    if _model:
+        post_save.connect(_tree_changed, sender=_model, dispatch_uid='lab.eligibility.%s.save' % _model.__name__)
+        post_delete.connect(_tree_changed, sender=_model, dispatch_uid='lab.eligibility.%s.delete' % _model.__name__)
@@ -0,0 +1,358 @@
+from django.conf import settings
+from django.db import transaction
+
+from collections import defaultdict, deque
+import datetime
+import heapq
+import itertools
+
+from .models import *
+from . import availability
+from .slots import SlotExpander
+
+import utils
+
+'''
+In-memory scheduling engine for VisitBuilder.
+Everything the slot / loc matching needs (week / day / time configs, on/off rules, existing visits)
+is loaded once per run (or per period for visits), instead of querying per time slot.
+'''
+
+class PeriodVisits(object):
+
+    # existing visits within a period, same range semantics as ForceVisit.objects.filter(datetime__range=(start, end)).
+
+    def __init__(self, node, start, end):
+        self.node = node
+        self.start = datetime.datetime.combine(start, datetime.time())
+        self.end = datetime.datetime.combine(end, datetime.time())
+        self.node_dts = set()
+        self.locs = set()
+        for nodeid, locid, dt in ForceVisit.objects.filter(datetime__range=(start, end)).values_list('node_id', 'loc_id', 'datetime'):
+            self._add(nodeid, locid, dt)
+
+    def _add(self, nodeid, locid, dt):
+        if nodeid == self.node.id:
+            self.node_dts.add(dt)
+        self.locs.add(locid)
+
+    def add(self, visit):
+        if self.start <= visit.datetime <= self.end:
+            self._add(visit.node_id, visit.loc_id, visit.datetime)
+
+    def has_node(self, dt):
+        return dt in self.node_dts
+
+    def has_loc(self, loc):
+        return loc.id in self.locs
+
+
+
+class VisitWriter(object):
+
+    # pending visits, written with bulk_create in batches of settings.LAB_BUILDER_BATCH.
+
+    def __init__(self, batch=None):
+        self.batch = batch or getattr(settings, 'LAB_BUILDER_BATCH', 500)
+        self.pending = []
+        self.qty = 0
+
+    def add(self, visit):
+        self.pending.append(visit)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            ForceVisit.objects.bulk_create(self.pending, batch_size=self.batch)
+            self.qty += len(self.pending)
+            self.pending = []
+
+
+
+class PlanWriter(object):
+
+    # same interface as VisitWriter, but nothing is written, visits are kept as pending.
+
+    def __init__(self):
+        self.pending = []
+
+    def add(self, visit):
+        self.pending.append(visit)
+
+    def flush(self):
+        pass
+
+
+
+class LocQueue(object):
+
+    '''
+    Builder locs, in sort order. Each slot takes the first available loc, dropping the already visited ones found
+    before it, and the others keep their place (so the relative order never changes), i.e. a deque where tried locs
+    are put back at the front. Locs unavailable for a whole day are parked during that day, instead of being
+    re-tried on every slot, and merged back in place (by sequence) afterwards.
+    '''
+
+    def __init__(self, locs):
+        self.locs = deque(enumerate(locs)) # (seq, loc).
+        self.parked = []
+
+    def __len__(self):
+        return len(self.locs) + len(self.parked)
+
+    def park(self, isoff):
+        active = deque()
+        for e in self.locs:
+            (self.parked if isoff(e[1]) else active).append(e)
+        self.locs = active
+
+    def unpark(self):
+        if self.parked:
+            self.locs = deque(heapq.merge(self.locs, self.parked))
+            self.parked = []
+
+    def take(self, isvisited, ison):
+        # (loc or None, qty of dropped visited locs).
+        tried = []
+        skips = 0
+        v = None
+        while self.locs:
+            e = self.locs.popleft()
+            loc = e[1]
+            if isvisited(loc):
+                skips += 1
+            elif ison(loc):
+                v = loc
+                break
+            else:
+                tried.append(e)
+        self.locs.extendleft(reversed(tried))
+        return v, skips
+
+
+
+class VisitEngine(object):
+
+    def __init__(self, builder, sys, locs, periods, timer=None, kept=()):
+        self.builder = builder
+        self.kept = set(kept) # datetimes of this builder visits, kept @ VisitBuilder._regenerate.
+        self.sys = sys
+        self.locs = LocQueue(locs)
+        self.periods = periods
+        self.node = builder.node
+        self.user = self.node.user
+        self.timer = timer = timer or utils.Timer(enabled=False)
+        with timer.phase('onoff'):
+            self.calendar = availability.calendar()
+            self.user_avail = availability.user_visit(self.user, sys)
+            self.locs_avail = availability.locs_visited(locs, sys)
+        self.expander = SlotExpander(builder.duration, builder.gap, calendar=self.calendar)
+        # phases @ simulate, NO overhead otherwise.
+        self._user_ison = timer.wrap('onoff', self._user_ison)
+        self._loc_ison = timer.wrap('onoff', self._loc_ison)
+
+    def _user_ison(self, dt):
+        return self.user_avail.ison(self.calendar, dt)
+
+    def _loc_ison(self, dt, loc):
+        return self.locs_avail[loc.id].ison(self.calendar, dt)
+
+    def slots(self, period, start, end):
+        return self.expander.slots(period.week_id or self.sys.week_period_id, start, end)
+
+    def _slot(self, dt, locs, pvisits, writer, visits):
+        b = self.builder
+        b.qty_slots += 1
+        if dt in self.kept: # NOT a node skip, counted @ qty_visits (see VisitBuilder._regenerate).
+            pass
+        elif self._user_ison(dt):
+            if pvisits.has_node(dt): # visit already generated for the node in this time slot.
+                b.qty_node_skips += 1
+            else:
+                # try (potentially multiple) locs for this specific time slot.
+                loc, skips = locs.take(pvisits.has_loc, lambda loc: self._loc_ison(dt, loc)) # skips: loc already visited during this period.
+                b.qty_locs_skips += skips
+                if loc:
+                    visit = ForceVisit(
+                        builder = b,
+                        node = self.node,
+                        loc = loc,
+                        datetime = dt,
+                        duration = b.duration,
+                    )
+                    visit.period_range = (pvisits.start, pvisits.end) # @ PlanMerger.
+                    pvisits.add(visit)
+                    writer.add(visit)
+                    visits.append(visit)
+                    b.qty_visits += 1
+
+    def run(self, writer, begin=None, progress=None):
+        # begin: called first in each day transaction (e.g. lock the builder), progress: after each day commit.
+        b = self.builder
+        locs = self.locs
+        b.qty_slots = 0
+        b.qty_slots_skips = 0
+        b.qty_locs = len(locs)
+        b.qty_locs_skips = 0
+        b.qty_node_skips = 0
+        b.qty_visits = 0
+        visits = []
+        for ep in self.periods:
+            start, end = ep.dates()
+            with self.timer.phase('conflicts'):
+                pvisits = PeriodVisits(self.node, start, end)
+                for visit in writer.pending: # NOT written yet (e.g. PlanWriter), previous periods could overlap with this one.
+                    pvisits.add(visit)
+                pvisits.has_node = self.timer.wrap('conflicts', pvisits.has_node)
+                pvisits.has_loc = self.timer.wrap('conflicts', pvisits.has_loc)
+            print 'VisitEngine > ep', ep, start, end
+            # one transaction per day, instead of a single one for the whole builder.
+            slots = self.timer.wrap_iter('periods', self.slots(ep, start, end))
+            for edate, dts in itertools.groupby(slots, lambda dt: dt.date()):
+                # visited locs are NOT parked, so they are still dropped (and counted) when reached.
+                locs.park(lambda loc: not pvisits.has_loc(loc) and self.locs_avail[loc.id].day_off(self.calendar, edate))
+                with transaction.atomic():
+                    if begin:
+                        begin()
+                    for dt in dts:
+                        self._slot(dt, locs, pvisits, writer, visits)
+                    writer.flush()
+                locs.unpark()
+                if progress:
+                    progress()
+        return visits
+
+
+
+class PlanMerger(object):
+
+    # conflict checks across independently planned builders, same rules as VisitEngine (node slot & loc per period).
+
+    def __init__(self):
+        self.node_dts = set()
+        self.loc_dts = defaultdict(list)
+
+    def accept(self, nodeid, locid, dt, period_range):
+        start, end = period_range
+        if (nodeid, dt) in self.node_dts:
+            return 'node'
+        if any([ start <= edt <= end for edt in self.loc_dts[locid] ]):
+            return 'loc'
+        self.node_dts.add((nodeid, dt))
+        self.loc_dts[locid].append(dt)
+        return None
+
+def plan_builder(builderid):
+    # work unit @ generate_builders, runs in a pool process: plans ONE builder (node & all its periods) without writing.
+    try:
+        builder = VisitBuilder.objects.get(pk=builderid)
+        with utils.versions_scope(): # shared versions read once per builder, as per request.
+            engine = builder._generate_engine()
+            visits = engine.run(PlanWriter()) if engine else None
+        plan = None
+        if engine:
+            plan = dict(
+                qty = dict([ (k, getattr(builder, k)) for k in builder.qty_fields ]),
+                visits = [ (visit.loc_id, visit.datetime, visit.period_range) for visit in visits ],
+            )
+        return dict(id=builderid, plan=plan)
+    except Exception as e:
+        return dict(id=builderid, error=repr(e))
+
+def _plan_write(job, plan, merger):
+    qty = plan['qty']
+    writer = VisitWriter()
+    with transaction.atomic():
+        builder = job.builder
+        if builder._generate_lock(job.beat) is not None: # same as VisitBuilder._generate.
+            raise BuilderJobLost('Already generated: %s' % builder)
+        for locid, dt, period_range in plan['visits']:
+            conflict = merger.accept(builder.node_id, locid, dt, period_range)
+            if conflict: # planned by a previous builder in this run.
+                k = 'qty_node_skips' if conflict == 'node' else 'qty_locs_skips'
+                qty[k] += 1
+            else:
+                writer.add(ForceVisit(
+                    builder = builder,
+                    node_id = builder.node_id,
+                    loc_id = locid,
+                    datetime = dt,
+                    duration = builder.duration,
+                ))
+        writer.flush()
+        qty['qty_visits'] = writer.qty
+        utils.db_update(builder, **qty) # marks as generated.
+
+def generate_builders(jobs, processes=None):
+    """
+    Plans the builders of the given (claimed) jobs in parallel, one process per builder,
+    then merges & writes them in order, skipping visits that conflict with previously merged builders.
+    """
+    from django.db import connections
+    import multiprocessing
+    # claimed jobs wait for the others (regenerations, planning, writes): ALL unfinished ones beat meanwhile, so they are
+    # NOT stale (see BuilderJob.stale) and re-claimed by a run_builders worker. A lost one (beat False) is left to its new owner.
+    waiting = list(jobs)
+    every = getattr(settings, 'LAB_BUILDER_STALE', 600) / 4.0
+    def _beat():
+        waiting[:] = [ job for job in waiting if job.beat() ]
+    def _done(job):
+        if job in waiting:
+            waiting.remove(job)
+    # already generated builders (e.g. conds edited) are re-generated incrementally (BuilderJob.run), NOT planned from scratch.
+    regenerate = [ job for job in jobs if job.builder.generated ]
+    jobs = [ job for job in jobs if job not in regenerate ]
+    for job in regenerate:
+        _beat()
+        if job not in waiting:
+            continue
+        try:
+            job.run()
+        except Exception as e:
+            print 'generate_builders > %s' % job, repr(e)
+        else:
+            print 'generate_builders > %s' % job
+        _done(job)
+    ids = [ job.builder_id for job in jobs ]
+    if not ids:
+        return []
+    if processes == 1:
+        results = []
+        for builderid in ids:
+            _beat()
+            results.append(plan_builder(builderid))
+    else:
+        for conn in connections.all():
+            conn.close() # each process must open its own connection.
+        pool = multiprocessing.Pool(processes)
+        try:
+            planned = pool.map_async(plan_builder, ids)
+            while not planned.ready():
+                _beat()
+                planned.wait(every)
+            results = planned.get()
+        finally:
+            pool.close()
+            pool.join()
+    merger = PlanMerger()
+    for job, result in zip(jobs, results):
+        _beat()
+        if job not in waiting:
+            print 'generate_builders > %s' % job, 'lost'
+            continue
+        error = result.get('error')
+        plan = result.get('plan')
+        if plan and not error:
+            try:
+                _plan_write(job, plan, merger)
+            except BuilderJobLost as e:
+                print 'generate_builders > %s' % job, repr(e)
+                _done(job)
+                continue
+            except Exception as e:
+                error = repr(e)
+        job.finish(error)
+        _done(job)
+        print 'generate_builders > %s' % job, error or ''
+    return results
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from lab.models import *
+from lab.engine import generate_builders
+from optparse import make_option
+
+# Parallel generation of many builders (e.g. a nightly run for the whole force), one process per builder:
+#   python manage.py generate_builders              # all queued builders.
+#   python manage.py generate_builders 3 5 8 -p 4   # given builders, 4 processes.
+# Periods of the SAME builder share its loc queue (a loc is visited once per builder), so they are NOT split.
+
+class Command(BaseCommand):
+    args = '[builder ids]'
+    help = 'generate_builders'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--processes', type='int', dest='processes', default=None, help='Pool size, defaults to the number of cores.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        jobs = []
+        if args:
+            for builderid in args:
+                builder = utils.db_get(VisitBuilder, builderid)
+                if not builder:
+                    raise CommandError('Builder NOT found: %s' % builderid)
+                if builder.generated:
+                    raise CommandError('Builder already generated: %s' % builder)
+                if not builder.generate:
+                    utils.db_update(builder, generate=True)
+                job = BuilderJob.enqueue(builder)
+                if job.claim():
+                    jobs.append(job)
+        else:
+            job = BuilderJob.next()
+            while job:
+                jobs.append(job)
+                job = BuilderJob.next()
+        self.stdout.write('generate_builders > %s jobs' % len(jobs))
+        if jobs:
+            generate_builders(jobs, processes=kwargs.get('processes'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from lab.models import *
+from optparse import make_option
+import time
+
+# Worker for queued VisitBuilder generations (BuilderJob), e.g. from cron or supervisor:
+#   python manage.py run_builders          # drain the queue and exit.
+#   python manage.py run_builders --loop   # keep polling.
+
+class Command(BaseCommand):
+    args = 'none'
+    help = 'run_builders'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False, help='Keep polling for queued jobs.'),
+        make_option('--sleep', type='int', dest='sleep', default=5, help='Seconds between polls @ --loop.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        while True:
+            job = BuilderJob.next()
+            if job:
+                self.stdout.write('run_builders > %s' % job)
+                try:
+                    job.run()
+                except Exception as e:
+                    self.stderr.write('ERROR @ run_builders: %s > %r' % (job, e))
+            elif kwargs.get('loop'):
+                time.sleep(kwargs.get('sleep'))
+            else:
+                break
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from lab.models import *
+from optparse import make_option
+import json
+
+# Dry-run of a VisitBuilder, nothing is written:
+#   python manage.py simulate_builder 3              # projected qty_* & timings per phase.
+#   python manage.py simulate_builder 3 --schedule   # + resulting schedule.
+
+class Command(BaseCommand):
+    args = '<builder id>'
+    help = 'simulate_builder'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--schedule', action='store_true', dest='schedule', default=False, help='Include the resulting schedule.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if len(args) != 1:
+            raise CommandError('Usage: simulate_builder <builder id>')
+        builder = utils.db_get(VisitBuilder, args[0])
+        if not builder:
+            raise CommandError('Builder NOT found: %s' % args[0])
+        v = builder.simulate()
+        if not kwargs.get('schedule'):
+            v['schedule'] = len(v['schedule'])
+        self.stdout.write(json.dumps(v, indent=2))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+import lab.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0003_forcevisit_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuilderJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('syscode', lab.models.GoNullableUniqueField(max_length=200, unique=True, null=True, blank=True)),
+                ('status', models.CharField(default=b'q', max_length=2, choices=[(b'q', b'Queued'), (b'r', b'Running'), (b'd', b'Done'), (b'e', b'Error')])),
+                ('queued', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('started', models.DateTimeField(null=True, editable=False, blank=True)),
+                ('finished', models.DateTimeField(null=True, editable=False, blank=True)),
+                ('error', models.TextField(editable=False, blank=True)),
+                ('builder', models.ForeignKey(related_name='jobs', to='lab.VisitBuilder')),
+            ],
+            options={
+                'ordering': ('-queued', '-id'),
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0004_builderjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='visitbuilder',
+            name='orderby',
+            field=models.CharField(default=b'zip', max_length=100, choices=[(b'area', b'area'), (b'city', b'city'), (b'state', b'state'), (b'country', b'country'), (b'zip', b'zip'), (b'brick', b'brick'), (b'country,state,city', b'country > state > city'), (b'country,state,city,area', b'country > state > city > area'), (b'country,state,city,zip', b'country > state > city > zip'), (b'brick,zip', b'brick > zip'), (b'brick,zip,area', b'brick > zip > area')]),
+            preserve_default=True,
+        ),
+    ]
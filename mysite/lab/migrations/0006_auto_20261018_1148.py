@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0005_auto_20261018_1106'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='forcevisit',
+            index_together=set([('datetime', 'id')]),
+        ),
+    ]
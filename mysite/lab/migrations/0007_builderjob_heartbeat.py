@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lab', '0006_auto_20261018_1148'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='builderjob',
+            name='heartbeat',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.utils.translation import ugettext as _ # use ugettext_lazy instead?.
 from django.utils import timezone
 
+from contextlib import contextmanager
 from decimal import Decimal
 import datetime
 import json
@@ -108,6 +110,11 @@ def _choices(vmax, choices, **kwargs):
     # print '_choices', choices
     return _char(**_kw_merge(kwargs, max_length=vmax, default=choices[0][0], choices=choices))
 
+def _memo(d, k, fn):
+    if k not in d:
+        d[k] = fn()
+    return d[k]
+
 def multiple_(row, prop):
     return ', '.join(sorted([ str(each) for each in getattr(row, prop).all() ]))
 
@@ -199,10 +206,45 @@ class AbstractTree(MPTTModel, AbstractModel):
     def str_level(self, diff=0):
         return ' -- ' * ((self.level or 0) - diff)
 
+    _tree_fields = ('tree_id', 'lft', 'rght', 'level')
+
+    def _tree_lock(self):
+        # saves / deletes of the same model wait for each other (roots select_for_update),
+        # then positions are re-read, as they could be stale (mptt updates ranges from them, and saves them).
+        manager = self.__class__._default_manager
+        list(manager.select_for_update().filter(level=0).values_list('id'))
+        nodes = [ node for node in [ self, self.parent ] if node and node.pk ]
+        fresh = dict([ (e['id'], e) for e in manager.filter(id__in=[ node.pk for node in nodes ]).values('id', *self._tree_fields) ])
+        for node in nodes:
+            for k in self._tree_fields:
+                if node.pk in fresh:
+                    setattr(node, k, fresh[node.pk][k])
+
     def save(self, *args, **kwargs):
         # print 'AbstractTree.save', self, args, kwargs
-        super(AbstractTree, self).save(*args, **kwargs)
-        self.__class__.objects.rebuild()
+        # incremental (mptt: only the affected lft / rght ranges, order_insertion_by included), NOT a full rebuild.
+        with transaction.atomic():
+            self._tree_lock()
+            super(AbstractTree, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self._tree_lock()
+            super(AbstractTree, self).delete(*args, **kwargs)
+
+    @classmethod
+    @contextmanager
+    def deferred(cls):
+        '''
+        Bulk loads (e.g. imports): tree updates are delayed until the end, then ONE (partial) rebuild of the changed trees.
+            with LocCat.deferred():
+                for ...: LocCat.objects.create(...)
+        '''
+        with transaction.atomic():
+            with cls._tree_manager.delay_mptt_updates():
+                yield
+        from . import trees
+        trees.invalidate(cls) # again, after the rebuild (lft / rght).
 
 
 
@@ -601,6 +643,16 @@ class ForceNode(AbstractTree):
     def itemcats_(self):
         return multiple_(self, 'itemcats')
 
+    def visits_data(self):
+        # @ Form.get_forms_reps of its visits, cached @ lab.nodes.
+        upnodes = utils.tree_ups(self)
+        itemcats = utils.tree_all_downs(ItemCat.objects.filter(nodes__in=upnodes).distinct())
+        return dict(
+            upnodes = upnodes,
+            itemcats = itemcats,
+            items = list(ItemCat.els_get(itemcats)),
+        )
+
     def bricks_(self):
         return multiple_(self, 'bricks')
 
@@ -646,37 +698,27 @@ class ForceVisit(AbstractFormRec):
     f_goal = _choices(30, [ 'Presentacion Inicial', 'Promocion', 'Pedido', 'Negociar' ])
     f_option = _choices(30, [ 'Planeada', 'Re-agendada', 'Asignada' ])
 
+    class Meta(AbstractFormRec.Meta):
+        index_together = (('datetime', 'id'),) # keyset pagination @ api.
+
     def __unicode__(self):
         return _str(self, 'Force Visit: %s > %s @ %s', (self.datetime, self.node, self.loc))
 
-    def prep(self, private):
-        # print 'prep', self.id, private
-        cached = dict()
-        def _node_data(_node):
-            d = cached.get(_node)
-            iscached = d is not None
-            if not iscached:
-                _upnodes = utils.tree_ups(_node)
-                _itemcats = utils.tree_all_downs(utils.list_flatten(_upnodes, lambda enode: enode.itemcats.all()))
-                d = dict(
-                    upnodes = _upnodes,
-                    itemcats = _itemcats,
-                    items = ItemCat.els_get(_itemcats),
-                )
-                cached[_node] = d
-            # print '_node_data cached', iscached, _node, d
-            return d
+    # prep plan: all prep (get_forms_reps_many & repr included) reads, loaded for many visits in a constant number of queries.
+    prep_related = ('node__user', 'loc__user') + tuple([ 'loc__%saddress__area__%s' % (prefix, path) for prefix in [ '', 'place__' ] for path in [ 'zip__brick', 'city__state__country' ] ])
+    prep_prefetch = ('loc__user__cats', 'loc__cats')
+
+    @classmethod
+    def prep_queryset(cls, visits=None):
+        visits = cls.objects.all() if visits is None else visits
+        return visits.select_related(*cls.prep_related).prefetch_related(*cls.prep_prefetch)
 
+    def prep(self, private, reps=None):
+        # print 'prep', self.id, private
+        # reps: this visit @ Form.get_forms_reps_many, when preparing many.
         loc = self.loc
         user = loc.user
-        formtypes, forms_ids, repdict_items_ids, repdict_usercats_ids = Form.get_forms_reps(
-            baseuser = user,
-            private = private,
-            visit = self,
-            usercats = user.cats.all(),
-            loccats = loc.cats.all(),
-            **_node_data(self.node)
-        )
+        formtypes, forms_ids, repdict_items_ids, repdict_usercats_ids = reps or Form.get_forms_reps_many([ self ], private)[self.id]
         addr = loc.addr()
         def _dt(datetime):
             return str(datetime) if datetime else ''
@@ -707,9 +749,9 @@ class ForceVisit(AbstractFormRec):
         # print 'prep', self, v
         return v
 
-    def _get_prep(self, private):
+    def _get_prep(self, private, reps=None):
         import json
-        v = self.prep(private)
+        v = self.prep(private, reps=reps)
         return json.dumps(v)
 
     def get_prep_public(self):
@@ -776,14 +818,20 @@ class Form(AbstractModel):
         user = None, visit = None, # user or visit.
         usercats = None, loccats = None, # common.
         upnodes = None, itemcats = None, items = None, # visit.
+        ctx = None, # memo shared by many calls, see get_forms_reps_many.
     ):
         # print 'get_forms_reps', private, user or visit
         if not baseuser: error
         if visit if user else not visit: error
+        from . import eligibility, trees
+        ctx = dict() if ctx is None else ctx
         repdict_items = dict()
         repdict_usercats = dict()
         types = []
-        _any = utils.tree_any
+        index = _memo(ctx, 'index', eligibility.index) # cats (and their ancestors) => forms / rep items, instead of ancestor & m2m queries per form / item.
+        if visit:
+            # rep items of the node, visible @ this visit usercats / loccats.
+            itemids = set([ e.id for e in items ]) & index.items_visible(usercats, loccats)
         def _doreps(form):
             def _reps(isitems, repdict, reps):
                 # print '_doreps > reps', reps
@@ -791,55 +839,46 @@ class Form(AbstractModel):
                     # user will get ALL reps (items / usercats) without any filtering, as opposed to visit.
                     isvisititems = isitems and not user
                     if isvisititems:
-                        reps = reps.filter(id__in=items).all()
+                        reps = [ erep for erep in reps if erep.id in itemids ]
                     for erep in reps:
-                        if _any(usercats, erep.visits_usercats) or _any(loccats, erep.visits_loccats) if isvisititems else True:
-                            '''
-                            repdict:
-                              @ visit = dict[erep] = forms
-                              @ user = dict[form] = reps (items / usercats)
-                            '''
-                            k = form.id if user else erep.id
-                            rforms = repdict.get(k) or []
-                            repdict[k] = rforms
-                            rforms.append(erep if user else form)
+                        '''
+                        repdict:
+                          @ visit = dict[erep] = forms
+                          @ user = dict[form] = reps (items / usercats)
+                        '''
+                        k = form.id if user else erep.id
+                        rforms = repdict.get(k) or []
+                        repdict[k] = rforms
+                        rforms.append(erep if user else form)
                     return True
                 return False
             def _reps_items():
-                reps1 = form.repitems.all()
-                repcats = utils.tree_all_downs(form.repitemcats.all())
-                reps2 = ItemCat.els_get(repcats)
-                nreps = (reps1 | reps2).distinct()
+                nreps = index.form_reps(form)
                 return _reps(True, repdict_items, nreps)
             def _reps_usercats():
-                ucats = utils.tree_all_downs(form.repusercats.all())
-                ucats2 = baseuser.allcats()
+                ucats = index.form_reps_usercats(form)
+                ucats2 = _memo(ctx, ('allcats', baseuser.id), lambda: _memo(ctx, ('tree', UserCat), lambda: trees.get(UserCat)).all_downs(baseuser.cats.all()))
                 nreps = ucats & ucats2
                 # print '_reps_usercats', baseuser, len(ucats), len(ucats2), len(nreps)
                 return _reps(False, repdict_usercats, nreps)
             # priority to repitems, then (if none) repusercats.
-            types.extend(form.types.all())
+            types.extend(_memo(ctx, ('types', form.id), lambda: list(form.types.all())))
             return not (_reps_items() or _reps_usercats())
-        forms = Form.objects.filter(scope='users' if user else 'visits')
-        forms = [ form for form in forms
-                  if (
-                      form.private is private and (
-                          False
-                          or (user and (
-                              False
-                              or _any(usercats, form.users_usercats)
-                              or _any(loccats, form.users_loccats)
-                          ))
-                          or (visit and (
-                              False
-                              or _any(usercats, form.visits_usercats)
-                              or _any(loccats, form.visits_loccats)
-                              or visit.loc.addr().area.zip.brick in form.visits_bricks.all()
-                              or _any(upnodes, form.visits_forcenodes, ups=False)
-                              or _any(itemcats, form.visits_itemcats)
-                          ))
-                      )
-                  ) and _doreps(form) ]
+        if user:
+            formids = index.forms_ids('users', private,
+                users_usercats = usercats,
+                users_loccats = loccats,
+            )
+        else:
+            formids = index.forms_ids('visits', private,
+                visits_usercats = usercats,
+                visits_loccats = loccats,
+                visits_bricks = [ visit.loc.addr().area.zip.brick_id ],
+                visits_forcenodes = upnodes,
+                visits_itemcats = itemcats,
+            )
+        forms = _memo(ctx, 'forms', lambda: list(Form.objects.all())) if formids else []
+        forms = [ form for form in forms if form.id in formids and _doreps(form) ]
         if ids:
             forms = utils.db_ids(forms)
             for repdict in [ repdict_items, repdict_usercats ]:
@@ -849,6 +888,38 @@ class Form(AbstractModel):
         # print 'get_forms_reps', private, user or visit, types, forms, repdict_items, repdict_usercats
         return types, forms, repdict_items, repdict_usercats
 
+    @classmethod
+    def get_forms_reps_many(cls, visits, private=False):
+        '''
+        get_forms_reps of many visits at once (e.g. agenda): visit id => (formtypes, forms, repdict_items, repdict_usercats).
+        Visits of the same node & loc get the same result, and node / user / form / item data is shared by all of them.
+        '''
+        from . import eligibility, nodes, trees
+        results = dict() # (node, loc) => result.
+        v = dict()
+        with utils.versions_scope(): # e.g. exports, NOT @ a request.
+            # resolved once, NOT per (node, loc).
+            ctx = {
+                'index': eligibility.index(),
+                ('tree', UserCat): trees.get(UserCat),
+            }
+            for visit in visits:
+                k = (visit.node_id, visit.loc_id)
+                if k not in results:
+                    loc = visit.loc
+                    user = loc.user
+                    results[k] = cls.get_forms_reps(
+                        baseuser = user,
+                        private = private,
+                        visit = visit,
+                        usercats = _memo(ctx, ('usercats', user.id), lambda: list(user.cats.all())),
+                        loccats = list(loc.cats.all()),
+                        ctx = ctx,
+                        **_memo(ctx, ('node', visit.node_id), lambda: nodes.get(visit.node)) # cached across requests.
+                    )
+                v[visit.id] = results[k]
+        return v
+
     '''
     # can't access multiple vals during validation?, it incorrectly returns previous values instead.
     def clean(self, *args, **kwargs):
@@ -933,13 +1004,15 @@ class FormField(AbstractModel):
             else: # optscat, optscat-all.
                 cat = self.optscat
                 if cat:
+                    from . import trees
+                    tree = trees.get(cat.__class__)
                     if self.type == 'optscat':
-                        opts = cat.children
+                        opts = tree.node_children(cat)
                         fn = lambda ecat: ecat.name
                     else:
-                        opts = cat.get_descendants()
+                        opts = tree.node_downs(cat, include_self=False)
                         fn = lambda ecat: '%s %s' % (ecat.str_level(diff=cat.level + 1), ecat.name)
-                    opts = [ (str(ecat.id), fn(ecat)) for ecat in opts.all() ]
+                    opts = [ (str(ecat.id), fn(ecat)) for ecat in opts ]
         if opts is not None and not self.required:
             opts.insert(0, ('', '-'))
         return opts
@@ -1006,6 +1079,18 @@ def _qn_or(_qn):
 def _qty():
     return _int_blank(default=None, editable=False)
 
+# VisitBuilder.orderby, Address => level.
+_orderby_paths = dict(
+    area = ('area',),
+    zip = ('area', 'zip'),
+    brick = ('area', 'zip', 'brick'),
+    city = ('area', 'city'),
+    state = ('area', 'city', 'state'),
+    country = ('area', 'city', 'state', 'country'),
+)
+
+_orderby_related = ('user',) + tuple([ '%saddress__area__%s' % (prefix, path) for prefix in [ '', 'place__' ] for path in [ 'zip__brick', 'city__state__country' ] ])
+
 class VisitBuilder(AbstractModel):
 
     qty_slots = _qty()
@@ -1027,9 +1112,18 @@ class VisitBuilder(AbstractModel):
     periods = _many(Period, 'builders')
     periodcats = _many_tree(PeriodCat, 'builders')
 
-    orderby = _choices(20, [ 'area', 'city', 'state', 'country', 'zip', 'brick' ], default='zip')
+    orderby = _choices(100, [
+        'area', 'city', 'state', 'country', 'zip', 'brick',
+        ('country,state,city', 'country > state > city'),
+        ('country,state,city,area', 'country > state > city > area'),
+        ('country,state,city,zip', 'country > state > city > zip'),
+        ('brick,zip', 'brick > zip'),
+        ('brick,zip,area', 'brick > zip > area'),
+    ], default='zip')
     isand = _boolean(True, help_text='Check to use [AND] & [OR] levels, otherwise [OR] & [AND]. Note that [OR] is always implicit within each group.')
 
+    qty_fields = ('qty_slots', 'qty_slots_skips', 'qty_locs', 'qty_locs_skips', 'qty_node_skips', 'qty_visits')
+
     class Meta:
         ordering = ('name',)
 
@@ -1040,9 +1134,14 @@ class VisitBuilder(AbstractModel):
         if self.generated:
             raise ValidationError('INVALID delete.')
 
+    def validate_pending(self):
+        if self.id and self.jobs.filter(status__in=BuilderJob.pending).exists():
+            raise ValidationError('NOT allowed to update, generation in progress.')
+
     def validate_generated(self):
         if self.generated:
             raise ValidationError('NOT allowed to update, already generated.')
+        self.validate_pending()
 
     def clean(self):
         self.validate_generated()
@@ -1059,13 +1158,154 @@ class VisitBuilder(AbstractModel):
     def _generate_check(self):
         print '_generate_check', self.generate
         if self.generate:
-            self._generate()
+            BuilderJob.enqueue(self) # run by a worker: python manage.py run_builders, incremental if already generated (e.g. conds edited).
+
+    def _generate_progress(self):
+        # update (NOT save) so the builder is NOT marked as generated until done.
+        VisitBuilder.objects.filter(pk=self.pk).update(**dict([ (k, getattr(self, k)) for k in self.qty_fields ]))
+
+    def _generate_reset(self, generate=False):
+        self.visits.all().delete()
+        for k in self.qty_fields:
+            setattr(self, k, None)
+        self.generate = generate
+        self.save()
+
+    def status(self):
+        job = self.jobs.first()
+        return dict(
+            id = self.id,
+            generate = self.generate,
+            generated = self.generated,
+            job = job.status_dict() if job else None,
+            **dict([ (k, getattr(self, k)) for k in self.qty_fields ])
+        )
+
+    def _generate_lock(self, beat=None):
+        # in the writing transaction: one writer per builder, e.g. a stale job re-claimed while its worker is still running
+        # (see BuilderJob._claim), the old worker stops here (beat False) instead of writing over the new one.
+        generated = list(VisitBuilder.objects.select_for_update().filter(pk=self.pk).values_list('generated', flat=True))
+        if beat and not beat():
+            raise BuilderJobLost('Re-claimed by another worker: %s' % self)
+        return generated[0] if generated else None
 
     # must be executed AFTER save, in order to have access to m2m relationships.
-    def _generate(self):
+    def _generate(self, beat=None):
+        engine = self._generate_engine()
+        if engine:
+            # committed day by day (see VisitEngine.run), so progress is visible while running.
+            from .engine import VisitWriter
+            def _begin():
+                if self._generate_lock(beat) is not None:
+                    raise BuilderJobLost('Already generated: %s' % self)
+            engine.run(VisitWriter(), begin=_begin, progress=self._generate_progress)
+            print 'done > generated visits & remaining locs', self.qty_visits, len(engine.locs)
+            with transaction.atomic():
+                _begin()
+                self.save()
+
+    def _regenerate(self, beat=None):
+        '''
+        Incremental re-generation, after conds edits of an already generated builder:
+        scheduled visits of locs NOT matching the conds anymore are dropped, the others are kept,
+        and only the new (or freed) locs are queued for the empty slots.
+        '''
+        with transaction.atomic():
+            self._generate_lock(beat) # one re-generation at a time.
+            locs = self._locs() or []
+            locids = set([ loc.id for loc in locs ])
+            drop = []
+            kept = set()
+            kept_dts = []
+            for visitid, locid, status, dt in self.visits.values_list('id', 'loc_id', 'status', 'datetime'):
+                if locid in locids or status != 's': # visited, etc. are kept anyway.
+                    kept.add(locid)
+                    kept_dts.append(dt)
+                else:
+                    drop.append(visitid)
+            if drop:
+                ForceVisit.objects.filter(id__in=drop).delete()
+            locs = [ loc for loc in locs if loc.id not in kept ] # a loc is visited once per builder.
+            print '_regenerate > dropped visits & new locs', len(drop), len(locs)
+            # every slot walked, even without new locs, so the qty are totals (same as a full generation of this schedule).
+            from .engine import VisitEngine, VisitWriter
+            engine = VisitEngine(self, Sys.objects.first(), locs, self._periods(), kept=kept_dts)
+            engine.run(VisitWriter())
+            self.qty_locs = len(locids)
+            self.qty_visits = self.visits.count()
+            self._generate_progress() # update, a generated builder can NOT be saved.
+
+    def _periods(self):
+        pcats = utils.tree_all_downs(self.periodcats.all())
+        pn1 = list(PeriodCat.els_get(pcats))
+        pn2 = list(self.periods.all())
+        return sorted(set(pn1 + pn2), key=lambda e: e.end)
+
+    def capacity(self):
+        # slots per period, without generating.
+        from .slots import SlotExpander
+        sys = Sys.objects.first()
+        expander = SlotExpander(self.duration, self.gap)
+        v = []
+        for ep in self._periods():
+            start, end = ep.dates()
+            v.append(dict(
+                period = ep.id,
+                name = ep.name,
+                start = start,
+                end = end,
+                slots = expander.capacity(ep.week_id or sys.week_period_id, start, end),
+            ))
+        return v
+
+    def simulate(self):
+        # dry-run: full slot / loc algorithm, nothing is written.
+        from .engine import PlanWriter
+        qty = dict([ (k, getattr(self, k)) for k in self.qty_fields ])
+        timer = utils.Timer()
+        engine = self._generate_engine(timer=timer, dryrun=True)
+        visits = engine.run(PlanWriter()) if engine else []
+        def _dt(dt):
+            return str(dt)
+        v = dict(
+            id = self.id,
+            conds = engine is not None,
+            schedule = [ dict(
+                loc = visit.loc.id,
+                loc_name = visit.loc.name,
+                datetime = _dt(visit.datetime),
+                end = _dt(utils.datetime_plus(visit.datetime, visit.duration)),
+            ) for visit in visits ],
+            timings = timer.report(),
+            **dict([ (k, getattr(self, k) if engine else None) for k in self.qty_fields ])
+        )
+        for k, val in qty.items(): # NOT saved, but restore anyway.
+            setattr(self, k, val)
+        return v
+
+    def _generate_engine(self, timer=None, dryrun=False):
+        timer = timer or utils.Timer(enabled=False)
         sys = Sys.objects.first()
         print '_generate', self, sys
 
+        locs = self._locs(timer)
+        if locs is None:
+            # raise ValidationError('Must select at least one condition for Users / Locs.')
+            if not dryrun:
+                self.generate = False
+                self.save()
+            return None # revert generate and ABORT, so we do NOT waste this builder.
+
+        pn = self._periods()
+        print 'pn', pn
+
+        from .engine import VisitEngine
+        return VisitEngine(self, sys, locs, pn, timer=timer)
+
+    def _locs(self, timer=None):
+        # locs matching the conds, in orderby order, None if there are NO conds.
+        timer = timer or utils.Timer(enabled=False)
+
         qn = [] # collection of multiple conds.
 
         def _qn_and_or(_qn, _isand):
@@ -1077,165 +1317,146 @@ class VisitBuilder(AbstractModel):
                 qn.append(_qn_and_or(eqn, not self.isand))
 
         if not qn: # not any ([ getattr(self, e).exists() for e in 'usercats loccats areas cities states countries zips bricks'.split() ])
-            # raise ValidationError('Must select at least one condition for Users / Locs.')
-            self.generate = False
-            self.save()
-            return # revert generate and ABORT, so we do NOT waste this builder.
-
-        if qn:
-            locs = Loc.objects.filter(_qn_and_or(qn, self.isand))
-            # print 'query', locs.query
-            locs = list(locs)
-        else:
-            locs = []
+            return None
+
+        with timer.phase('locs'):
+            if qn:
+                # whole address hierarchy (own or place address) in the same query, for the sort below.
+                locs = Loc.objects.filter(_qn_and_or(qn, self.isand)).select_related(*_orderby_related)
+                # print 'query', locs.query
+                locs = list(locs)
+            else:
+                locs = []
+
+        bys = [ _orderby_paths[by] for by in self.orderby.split(',') ] # composite, e.g. country > state > city.
 
         def _sortkey(eloc):
             addr = eloc.addr()
-            by = self.orderby
-            def _val():
-                v = addr.area
-                if by == 'area': return v
-                if by in [ 'zip', 'brick' ]:
-                    v = v.zip
-                    return v if by == 'zip' else v.brick
-                v = v.city
-                if by == 'city': return v
-                v = v.state
-                if by == 'state': return v
-                v = v.country
-                if by == 'country': return v
-                error
-            val = _val().name
-            # print '_sortkey', by, val, eloc
+            def _val(path):
+                v = addr
+                for each in path:
+                    v = getattr(v, each)
+                return v.name
+            val = tuple([ _val(path) for path in bys ])
+            # print '_sortkey', val, eloc
             return val
 
-        locs = sorted(locs, key=_sortkey)
-        print 'locs', len(locs), locs
+        with timer.phase('sort'):
+            locs = sorted(locs, key=_sortkey)
+        print 'locs', len(locs)
+        return locs
 
-        pcats = utils.tree_all_downs(self.periodcats.all())
-        pn1 = list(PeriodCat.els_get(pcats))
-        pn2 = list(self.periods.all())
-        pn = sorted(set(pn1 + pn2), key=lambda e: e.end)
-        print 'pn', pn
 
-        def _day(week, date):
-            return getattr(week, utils.weekdays[date.weekday()])
-
-        def _onoff(dt, week, sources, suffix):
-            day = _day(week, dt)
-            # print '_onoff', dt, week, day
-            ok = False
-            if day:
-                dtdate = dt.date()
-                dttime = dt.time()
-                intime = False
-                for time in day.times.all():
-                    if dttime >= time.start and dttime <= time.end:
-                        intime = True
-                        break
-                if intime:
-                    sources = utils.list_compact(sources) # remove None's.
-                    def _get(prefix, cmp2, checkdate):
-                        xn = utils.list_flatten(sources, lambda e: getattr(e, prefix + suffix).all())
-                        # print '_onoff._get', cmp2, xn
-                        def _filter(e):
-                            return cmp2 >= e.start and cmp2 <= e.end and (not e.date or e.date == dtdate if checkdate else True)
-                        return utils.list_last(sorted(
-                            [ e for e in xn if _filter(e) ],
-                            key = lambda e: e.start,
-                        ))
-                    def _ison(pt):
-                        return not pt or pt.on
-                    operiod = _get('onoffperiod', dtdate, False)
-                    if _ison(operiod):
-                        otime = _get('onofftime', dttime, True)
-                        if _ison(otime):
-                            ok = True
-            # if not ok: print '_onoff - FAILED', dt
-            return ok
 
+class BuilderJobLost(Exception):
+    pass # job re-claimed by another worker (stale, see BuilderJob.stale), this one stops without undoing anything.
+
+class BuilderJob(AbstractModel):
+
+    builder = _one(VisitBuilder, 'jobs')
+    status = _choices(2, [ ('q', 'Queued'), ('r', 'Running'), ('d', 'Done'), ('e', 'Error') ])
+    queued = _datetime_now(editable=False)
+    started = _datetime_blank(editable=False)
+    heartbeat = _datetime_blank(editable=False) # last sign of life of the running worker (claimed / day committed).
+    finished = _datetime_blank(editable=False)
+    error = _text(editable=False)
+
+    pending = ('q', 'r')
+
+    class Meta:
+        ordering = ('-queued', '-id')
+
+    def __unicode__(self):
+        return _str(self, 'Builder Job: %s > %s @ %s', (self.builder.name, self.get_status_display(), self.queued))
+
+    @classmethod
+    def enqueue(cls, builder):
+        job = builder.jobs.filter(status__in=cls.pending).first()
+        return job or cls.objects.create(builder=builder)
+
+    @classmethod
+    def stale(cls):
+        # running jobs without heartbeat since then, i.e. their worker died (killed, OOM, deploy): claimable again.
+        return datetime.datetime.now() - datetime.timedelta(seconds=getattr(settings, 'LAB_BUILDER_STALE', 600))
+
+    @classmethod
+    def _claim(cls, jobs):
+        # claim the oldest queued (or stale) job, with a conditional update per candidate so concurrent workers do NOT run
+        # the same job, and the loser of a race tries the next one (instead of waiting on a locked row, then NOTHING left).
+        stale = models.Q(status='r') & (models.Q(heartbeat__lt=cls.stale()) | models.Q(heartbeat__isnull=True))
+        for jobid, builderid in jobs.filter(models.Q(status='q') | stale).order_by('queued', 'id').values_list('id', 'builder_id'):
+            now = datetime.datetime.now().replace(microsecond=0) # started is the claim token (see beat), same @ every backend.
+            claimed = dict(status='r', started=now, heartbeat=now)
+            with transaction.atomic():
+                if cls.objects.filter(pk=jobid, status='q').update(**claimed):
+                    return cls.objects.get(pk=jobid)
+                # builder first, same lock order as its writers (see VisitBuilder._generate_lock).
+                list(VisitBuilder.objects.select_for_update().filter(pk=builderid).values_list('id'))
+                if cls.objects.filter(stale, pk=jobid).update(**claimed):
+                    job = cls.objects.get(pk=jobid)
+                    job._undo(generate=True) # re-generated from scratch by this claim, the old worker stops @ its next beat.
+                    return job
+        return None
+
+    @classmethod
+    def next(cls):
+        return cls._claim(cls.objects.all())
+
+    def _undo(self, generate=False):
+        # partial (committed) days of a generation, re-generations are a single transaction.
+        builder = self.builder
+        if not builder.generated:
+            builder._generate_reset(generate=generate)
+
+    def beat(self):
+        # job alive (see stale), False if NOT owned anymore, i.e. re-claimed by another worker (or reset @ admin).
+        return BuilderJob.objects.filter(pk=self.pk, status='r', started=self.started).update(heartbeat=datetime.datetime.now()) > 0
+
+    def run(self):
+        builder = self.builder
+        regenerate = builder.generated is not None # incremental, e.g. conds edited.
+        try:
+            with utils.versions_scope(): # shared versions read once per job, as per request.
+                if regenerate:
+                    builder._regenerate(beat=self.beat)
+                else:
+                    builder._generate(beat=self.beat)
+        except Exception as e:
+            with transaction.atomic():
+                generated = builder._generate_lock()
+                if self.beat(): # still owned, otherwise (e.g. BuilderJobLost) the new owner undoes / finishes it.
+                    if not regenerate and generated is None: # re-generation is a single transaction.
+                        builder._generate_reset() # generation commits day by day, so undo any partial visits.
+                    self.finish(repr(e))
+            raise
+        self.finish()
+
+    def claim(self):
+        # same as next, but for a given job (e.g. @ generate_builders), False if already claimed by another worker.
+        job = BuilderJob._claim(BuilderJob.objects.filter(pk=self.pk))
+        if job:
+            self.status, self.started, self.heartbeat = job.status, job.started, job.heartbeat
+        return job is not None
+
+    def reset(self, error='Reset.'):
+        # @ admin: stops blocking the builder (e.g. a dead worker), partial visits undone.
         with transaction.atomic():
-            mgr = ForceVisit.objects
-            self.qty_slots = 0
-            self.qty_slots_skips = 0
-            self.qty_locs = len(locs)
-            self.qty_locs_skips = 0
-            self.qty_node_skips = 0
-            nodeskips = 0
-            visits = []
-
-            for ep in pn:
-                start, end = ep.dates()
-                qv = mgr.filter(datetime__range=(start, end)) # query within the current period (start - end).
-                delta = end - start
-                dates = [ start + datetime.timedelta(days=i) for i in range(delta.days + 1) ]
-                week = ep.week or sys.week_period
-                print '_generate > ep', ep, week, start, end # dates
-                for edate in dates:
-                    day = _day(week, edate)
-                    print '_generate > edate', edate, day
-                    if day:
-                        def _datetime(_time): # can't use timedelta with simple times.
-                            return datetime.datetime.combine(edate, _time)
-                        for etime in day.times.all():
-                            dt = _datetime(etime.start)
-                            dt2 = _datetime(etime.end)
-                            while dt < dt2:
-                                self.qty_slots += 1
-                                # print '_generate > slot', dt
-                                user = self.node.user
-                                ison = _onoff(
-                                    dt,
-                                    (user.week_visit if user else None) or sys.week_user_visit,
-                                    [ user ],
-                                    '_visit',
-                                )
-                                if ison:
-                                    if qv.filter(node=self.node, datetime=dt).exists(): # visit already generated for the node in this time slot.
-                                        self.qty_node_skips += 1
-                                        print '_generate > qty_node_skips', dt, self.node
-                                    else:
-
-                                        # try (potentially multiple) locs for this specific time slot.
-                                        tryloc = True
-                                        locs2 = [] # queue for tried locs, which should be retried in the next time slot.
-                                        while locs and tryloc:
-                                            loc = locs.pop(0) if locs else None
-                                            # print '_tryloc', dt, loc
-                                            if loc:
-                                                if qv.filter(loc=loc): # loc already visited during this period.
-                                                    self.qty_locs_skips += 1
-                                                    print '_generate > qty_locs_skips', dt, loc
-                                                else:
-                                                    ison = _onoff(
-                                                        dt,
-                                                        loc.week or loc.user.week_visited or sys.week_user_visited,
-                                                        [ loc, loc.user ],
-                                                        '_visited',
-                                                    )
-                                                    if ison:
-                                                        visit = mgr.create(
-                                                            builder = self,
-                                                            node = self.node,
-                                                            loc = loc,
-                                                            datetime = dt,
-                                                            duration = self.duration,
-                                                        )
-                                                        print '==> _generate > visit', dt, visit
-                                                        visits.append(visit)
-                                                        tryloc = False
-                                                    else:
-                                                        # print '_generate > SKIP VISITED (locs2 queue)', dt, loc
-                                                        locs2.append(loc)
-                                        locs[0:0] = locs2 # re-insert in order at the beginning, for immediate try during the subsequent time slots.
-
-                                else:
-                                    # print '_generate > SKIP VISIT', dt, user
-                                    pass
-                                dt = utils.datetime_plus(dt, self.duration, self.gap)
-            self.qty_visits = len(visits)
-            print 'done > generated visits & remaining locs', self.qty_visits, len(locs)
-            self.save()
+            if self.status in self.pending:
+                self._undo()
+                self.finish(error)
+
+    def finish(self, error=None):
+        utils.db_update(self, status='e' if error else 'd', error=error or '', finished=datetime.datetime.now())
+
+    def status_dict(self):
+        return dict(
+            id = self.id,
+            status = self.status,
+            queued = self.queued,
+            started = self.started,
+            finished = self.finished,
+            error = self.error,
+        )
 
 
 
@@ -1262,7 +1483,7 @@ class VisitCond(AbstractModel):
 
     def clean(self):
         if self.builder:
-            self.builder.validate_generated()
+            self.builder.validate_pending() # generated builders are re-generated incrementally, see _regenerate.
 
     def qn(self):
         qn = []
@@ -1273,9 +1494,9 @@ class VisitCond(AbstractModel):
             ('user__cats__in', self.usercats),
             ('place__cats__in', self.placecats),
         ]:
-            if mrel.exists():
-                mrel = utils.tree_all_downs(mrel.all())
-                qn.append(_q(fname, mrel))
+            mrel = list(mrel.all())
+            if mrel:
+                qn.append(_q(fname, utils.tree_all_downs(mrel)))
 
         # addresses.
         tmpl = 'address__%s__in'
@@ -1358,3 +1579,16 @@ class Sys(AbstractModel):
 
     def delete(self, *args, **kwargs):
         raise ValidationError('Singleton - can NOT be deleted.')
+
+
+
+class SharedVersion(models.Model):
+
+    # versions of the process caches & agenda payloads (see utils.version_get), NOT @ the cache backend:
+    # bumped atomically (UPDATE version = version + 1), NOT evicted.
+
+    key = _char(unique=True)
+    version = models.BigIntegerField()
+
+    def __unicode__(self):
+        return _str(self, '%s @ %s', (self.key, self.version))
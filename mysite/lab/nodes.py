@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from collections import OrderedDict
+
+from .models import *
+
+import utils
+
+'''
+Per node context @ Form.get_forms_reps of its visits (upnodes, itemcats closure & their items, see ForceNode.visits_data),
+cached per process across requests, by ForceNode id, least recently used evicted (settings.LAB_NODES_CACHE).
+Dropped when the shared version (cache backend) changes, bumped by the signals below on ForceNode / ItemCat / Item changes.
+Cached elements are shared, so they must NOT be modified.
+'''
+
+_cached = utils.Versioned('lab.nodes.version') # nodes.
+
+def get(node):
+    nodes = _cached.get().setdefault('nodes', OrderedDict())
+    d = nodes.pop(node.id, None)
+    if d is None:
+        d = node.visits_data()
+        size = getattr(settings, 'LAB_NODES_CACHE', 1000)
+        while len(nodes) >= size:
+            nodes.popitem(last=False)
+    nodes[node.id] = d # most recently used, last.
+    return d
+
+def invalidate(**kwargs):
+    _cached.invalidate()
+
+for _model in [ ForceNode, ItemCat, Item ]:
+    post_save.connect(invalidate, sender=_model, dispatch_uid='lab.nodes.%s.save' % _model.__name__)
+    post_delete.connect(invalidate, sender=_model, dispatch_uid='lab.nodes.%s.delete' % _model.__name__)
+
+for _through in [ ForceNode.itemcats.through, Item.cats.through ]:
+    m2m_changed.connect(invalidate, sender=_through, dispatch_uid='lab.nodes.%s' % _through.__name__)
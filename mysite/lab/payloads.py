@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from .models import *
+
+import hashlib
+import json
+import utils
+
+'''
+Agenda payloads @ views._data, cached @ the cache backend (settings.CACHES, shared by processes) in sections:
+catalog (items, usercats, formtypes & forms, same for all, served apart @ views.catalog), user (user forms & recs) and visits (one fragment per visit),
+each keyed by its section version(s), so a change only drops what depends on it:
+a visit edit drops its own fragment, a rec edit the users, any other agenda data change bumps the data version.
+Dropped / bumped right away (the changing transaction sees its own rows), and again once committed (other processes may have
+re-built from the previous rows meanwhile) or rolled back (payloads built by the transaction), see utils.on_commit.
+'''
+
+_version_keys = dict(
+    catalog = 'lab.payloads.version.catalog',
+    data = 'lab.payloads.version.data',
+    recs = 'lab.payloads.version.recs',
+)
+
+_catalog_models = [ Item, UserCat, FormType, Form, FormField, GenericCat ]
+
+# read by the agenda payloads (besides ForceVisit & UserFormRec, see below): visit loc / address / user / node & form eligibility,
+# NOT e.g. builders, conds, periods, on / off or the PeriodCat / PlaceCat / FormCat trees.
+_data_models = _catalog_models + [ Country, State, City, Brick, Zip, Area, Address, Place, Loc, User, ForceNode, ItemCat, LocCat ]
+
+_unread_fields = {
+    User: set([ 'password', 'last_login' ]), # e.g. a login, saved with update_fields=['last_login'].
+}
+
+def _timeout():
+    return getattr(settings, 'LAB_AGENDA_TIMEOUT', 3600)
+
+def _version(section):
+    return utils.version_get(_version_keys[section])
+
+def _changed(fn):
+    fn()
+    if connection.in_atomic_block:
+        utils.on_commit(fn, fn)
+
+def _bump(section):
+    _changed(lambda: utils.version_bump(_version_keys[section]))
+
+def _cached(k, fn):
+    v = cache.get(k)
+    if v is None:
+        v = fn()
+        cache.set(k, v, _timeout())
+    return v
+
+def catalog(fn):
+    # fn() => dict, e.g. allitems, allforms => (etag, json body), the etag being the body hash (same @ all processes).
+    def _catalog():
+        body = json.dumps(fn(), sort_keys=True)
+        return (hashlib.md5(body).hexdigest(), body)
+    return _cached('lab.payloads.catalog.%s' % _version('catalog'), _catalog)
+
+def user(go_user, private, fn):
+    return _cached('lab.payloads.user.%s.%s.%s.%s' % (_version('data'), _version('recs'), go_user.id, int(private)), fn)
+
+def _visit_key(version, visitid, private):
+    return 'lab.payloads.visit.%s.%s.%s' % (version, visitid, int(private))
+
+def visits(ids, private, fn):
+    # fn(missing ids) => visit id => fragment, only those NOT cached are built.
+    version = _version('data')
+    keys = dict([ (_visit_key(version, visitid, private), visitid) for visitid in ids ])
+    cached = cache.get_many(keys.keys())
+    v = dict([ (keys[k], fragment) for k, fragment in cached.items() ])
+    missing = [ visitid for visitid in ids if visitid not in v ]
+    if missing:
+        built = fn(missing)
+        cache.set_many(dict([ (_visit_key(version, visitid, private), fragment) for visitid, fragment in built.items() ]), _timeout())
+        v.update(built)
+    return v
+
+def _visit_changed(instance, **kwargs):
+    visitid = instance.id
+    def _fn():
+        version = _version('data')
+        cache.delete_many([ _visit_key(version, visitid, private) for private in [ False, True ] ])
+    _changed(_fn)
+
+def _recs_changed(**kwargs):
+    _bump('recs')
+
+def _data_changed(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= _unread_fields.get(sender, set()):
+        return
+    _bump('data')
+    if sender in _catalog_models:
+        _bump('catalog')
+
+_rels_catalog = set() # through models of the catalog models m2m.
+
+def _rels_changed(sender, action, **kwargs):
+    if action in [ 'post_add', 'post_remove', 'post_clear' ]:
+        _bump('data')
+        if sender in _rels_catalog:
+            _bump('catalog')
+
+post_save.connect(_visit_changed, sender=ForceVisit, dispatch_uid='lab.payloads.ForceVisit.save')
+post_delete.connect(_visit_changed, sender=ForceVisit, dispatch_uid='lab.payloads.ForceVisit.delete')
+
+post_save.connect(_recs_changed, sender=UserFormRec, dispatch_uid='lab.payloads.UserFormRec.save')
+post_delete.connect(_recs_changed, sender=UserFormRec, dispatch_uid='lab.payloads.UserFormRec.delete')
+
+for _model in _data_models:
+    post_save.connect(_data_changed, sender=_model, dispatch_uid='lab.payloads.%s.save' % _model.__name__)
+    post_delete.connect(_data_changed, sender=_model, dispatch_uid='lab.payloads.%s.delete' % _model.__name__)
+    for _field in _model._meta.many_to_many:
+        # m2m between payload models only (e.g. NOT Form.cats / User.groups), auto through ones (ForceNode.locs is ForceVisit).
+        if _field.rel.to in _data_models and _field.rel.through._meta.auto_created:
+            if _model in _catalog_models:
+                _rels_catalog.add(_field.rel.through)
+            m2m_changed.connect(_rels_changed, sender=_field.rel.through, dispatch_uid='lab.payloads.%s.%s' % (_model.__name__, _field.name))
@@ -0,0 +1,49 @@
+import datetime
+
+from . import availability
+
+import utils
+
+'''
+Slot expansion: a WeekConfig plus a date range => lazy generator of slot datetimes, stepping by duration + gap
+through each TimeConfig window of the day (same as VisitBuilder).
+Slot times are computed once per distinct DayConfig (most days share one), then only combined with each date.
+'''
+
+class SlotExpander(object):
+
+    def __init__(self, duration, gap, calendar=None):
+        self.duration = duration
+        self.gap = gap
+        self.calendar = calendar or availability.calendar()
+        self.days = dict() # day id => [ slot times ].
+
+    def day(self, dayid):
+        times = self.days.get(dayid)
+        if times is None:
+            times = []
+            base = datetime.date(2000, 1, 1) # any date, windows do NOT cross midnight.
+            for start, end in self.calendar.day_times(dayid):
+                dt = datetime.datetime.combine(base, start)
+                dt2 = datetime.datetime.combine(base, end)
+                while dt < dt2:
+                    times.append(dt.time())
+                    dt = utils.datetime_plus(dt, self.duration, self.gap)
+            self.days[dayid] = times
+        return times
+
+    def _days(self, weekid, start, end):
+        for i in range((end - start).days + 1):
+            edate = start + datetime.timedelta(days=i)
+            dayid = self.calendar.day(weekid, edate)
+            if dayid:
+                yield edate, self.day(dayid)
+
+    def slots(self, weekid, start, end):
+        for edate, times in self._days(weekid, start, end):
+            for etime in times:
+                yield datetime.datetime.combine(edate, etime)
+
+    def capacity(self, weekid, start, end):
+        # number of slots, e.g. for reports, without building them.
+        return sum([ len(times) for edate, times in self._days(weekid, start, end) ])
@@ -1,11 +1,719 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.cache import cache
+from django.core.management import call_command
 from .models import *
+import itertools
 import utils
 
 # python manage.py test
 # Temporary test database, not affecting production.
 
+class LabTestCase(TransactionTestCase):
+
+    # committed, as the process caches are invalidated / patched on commit (see utils.on_commit).
+
+    def setUp(self):
+        cache.clear() # NOT flushed with the tables, while ids are re-used.
+
+# query budgets @ the real backend (settings.CACHES), as per request (see utils.versions_scope).
+
 class ForceVisitMethodTests(TestCase):
 
     def test_X(self):
         self.assertEqual(True, True)
+
+def _builder_setup():
+    day = DayConfig.objects.create(name='day')
+    TimeConfig.objects.create(day=day, start=datetime.time(9, 0), end=datetime.time(11, 0))
+    week = WeekConfig.objects.create(name='week', mon=day, tue=day, wed=day, thu=day, fri=day)
+    Sys.objects.create(week_user_visit=week, week_user_visited=week, week_period=week)
+    Period.objects.create(name='start', end=datetime.date(2015, 1, 4)) # sun.
+    period = Period.objects.create(name='week 1', end=datetime.date(2015, 1, 9))
+    country = Country.objects.create(name='country')
+    state = State.objects.create(name='state', country=country)
+    city = City.objects.create(name='city', state=state)
+    zip = Zip.objects.create(name='zip', brick=Brick.objects.create(name='brick'))
+    area = Area.objects.create(name='area', city=city, zip=zip)
+    rep = User.objects.create(email='rep@go.com')
+    node = ForceNode.objects.create(name='node', user=rep)
+    loccat = LocCat.objects.create(name='loccat')
+    locs = []
+    for i in range(6):
+        doc = User.objects.create(email='doc%s@go.com' % i)
+        loc = Loc.objects.create(name='loc %s' % i, user=doc, address=Address.objects.create(street='street %s' % i, area=area))
+        loc.cats.add(loccat)
+        locs.append(loc)
+    builder = VisitBuilder.objects.create(name='builder', node=node, duration=datetime.time(0, 45), gap=datetime.time(0, 15))
+    builder.periods.add(period)
+    cond = VisitCond.objects.create(builder=builder)
+    cond.loccats.add(loccat)
+    return builder, node, locs
+
+class VisitBuilderTests(LabTestCase):
+
+    def _generate(self, builder):
+        builder.generate = True
+        builder.save()
+        builder._generate_check()
+        call_command('run_builders')
+        return VisitBuilder.objects.get(pk=builder.pk)
+
+    def test_generate(self):
+        builder, node, locs = _builder_setup()
+        ForceVisit.objects.create(node=node, loc=locs[0], datetime=datetime.datetime(2015, 1, 5, 9, 0)) # node & loc skips.
+        OnOffPeriod.objects.create(visited_loc=locs[1], on=False, start=datetime.date(2015, 1, 5), end=datetime.date(2015, 1, 6))
+        builder = self._generate(builder)
+        self.assertTrue(builder.generated)
+        self.assertEqual(builder.qty_slots, 10) # 5 days x 2 slots.
+        self.assertEqual(builder.qty_node_skips, 1)
+        self.assertEqual(builder.qty_locs_skips, 1)
+        self.assertEqual(builder.qty_visits, 5)
+        visits = ForceVisit.objects.filter(builder=builder).order_by('datetime')
+        self.assertEqual(
+            [ (visit.loc.name, visit.datetime) for visit in visits ],
+            [
+                ('loc 2', datetime.datetime(2015, 1, 5, 10, 0)),
+                ('loc 3', datetime.datetime(2015, 1, 6, 9, 0)),
+                ('loc 4', datetime.datetime(2015, 1, 6, 10, 0)),
+                ('loc 1', datetime.datetime(2015, 1, 7, 9, 0)), # off until tue, re-tried first.
+                ('loc 5', datetime.datetime(2015, 1, 7, 10, 0)),
+            ]
+        )
+
+    def test_generate_batches(self):
+        builder, node, locs = _builder_setup()
+        with self.settings(LAB_BUILDER_BATCH=2):
+            builder = self._generate(builder)
+        self.assertEqual(builder.qty_visits, 6)
+        self.assertEqual(ForceVisit.objects.filter(builder=builder, node=node).count(), 6)
+
+    def test_generate_queued(self):
+        builder, node, locs = _builder_setup()
+        builder.generate = True
+        builder.save()
+        builder._generate_check()
+        builder._generate_check() # NOT queued twice.
+        self.assertEqual(builder.jobs.count(), 1)
+        self.assertEqual(builder.status()['job']['status'], 'q')
+        self.assertFalse(ForceVisit.objects.filter(builder=builder).exists())
+        self.assertRaises(ValidationError, builder.clean)
+        call_command('run_builders')
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        status = builder.status()
+        self.assertEqual(status['job']['status'], 'd')
+        self.assertEqual(status['qty_visits'], 6)
+        self.assertTrue(status['generated'])
+
+    def test_regenerate(self):
+        builder, node, locs = _builder_setup()
+        builder = self._generate(builder)
+        kept = dict(ForceVisit.objects.filter(builder=builder, loc__in=locs[2:]).values_list('loc_id', 'id'))
+        loccat = LocCat.objects.first()
+        for loc in locs[:2]:
+            loc.cats.remove(loccat)
+        loc = Loc.objects.create(name='loc 6', user=locs[0].user, address=Address.objects.create(street='street 6', area=Area.objects.first()))
+        loc.cats.add(loccat)
+        cond = builder.conds.first()
+        cond.clean() # generated builders can be edited, NOT while generating.
+        builder._generate_check()
+        self.assertEqual(builder.jobs.first().status, 'q')
+        self.assertRaises(ValidationError, cond.clean)
+        call_command('run_builders')
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        self.assertEqual(builder.jobs.first().status, 'd')
+        self.assertEqual([ getattr(builder, k) for k in builder.qty_fields ], [ 10, 0, 5, 0, 0, 5 ]) # totals, as a full generation (kept visits NOT node skips).
+        self.assertEqual(dict(ForceVisit.objects.filter(builder=builder, loc__in=locs[2:]).values_list('loc_id', 'id')), kept) # NOT re-created.
+        self.assertEqual(
+            list(ForceVisit.objects.filter(builder=builder).order_by('datetime').values_list('loc__name', 'datetime'))[:2],
+            [ ('loc 6', datetime.datetime(2015, 1, 5, 9, 0)), ('loc 2', datetime.datetime(2015, 1, 6, 9, 0)) ] # freed slot.
+        )
+
+    def test_regenerate_builders(self):
+        builder, node, locs = _builder_setup()
+        builder = self._generate(builder)
+        locs[0].cats.remove(LocCat.objects.first())
+        builder._generate_check()
+        call_command('generate_builders', processes=1) # queued re-generation, NOT a plan from scratch.
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        self.assertEqual(builder.jobs.first().status, 'd')
+        self.assertEqual(builder.qty_visits, 5)
+        self.assertEqual(builder.qty_slots, 10) # NO new locs, slots walked anyway.
+        self.assertFalse(ForceVisit.objects.filter(builder=builder, loc=locs[0]).exists())
+
+    def test_regenerate_admin_delete(self):
+        builder, node, locs = _builder_setup()
+        builder = self._generate(builder)
+        User.objects.create_superuser('admin@go.com', 'pwd')
+        self.client.login(email='admin@go.com', password='pwd')
+        cond = builder.conds.first()
+        self.client.post('/admin/lab/visitcond/', { 'action': 'delete_selected', '_selected_action': [ cond.id ], 'post': 'yes' }) # bulk.
+        self.assertFalse(VisitCond.objects.filter(pk=cond.pk).exists())
+        self.assertEqual(builder.jobs.first().status, 'q') # re-generation queued.
+
+    def test_generate_stale(self):
+        builder, node, locs = _builder_setup()
+        builder.generate = True
+        builder.save()
+        builder._generate_check()
+        job = BuilderJob.next()
+        ForceVisit.objects.create(node=node, loc=locs[0], builder=builder, datetime=datetime.datetime(2015, 1, 5, 9, 0)) # partial day, then the worker died.
+        self.assertIsNone(BuilderJob.next()) # running, NOT stale yet.
+        BuilderJob.objects.filter(pk=job.pk).update(heartbeat=datetime.datetime.now() - datetime.timedelta(hours=1))
+        call_command('run_builders')
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        self.assertEqual(BuilderJob.objects.get(pk=job.pk).status, 'd')
+        self.assertEqual(builder.qty_visits, 6)
+        self.assertEqual(ForceVisit.objects.filter(builder=builder).count(), 6) # partial day undone.
+        self.assertRaises(BuilderJobLost, job.run) # the old worker, still running: re-claimed, NO writes / undo.
+        self.assertEqual(BuilderJob.objects.get(pk=job.pk).status, 'd')
+        self.assertEqual(ForceVisit.objects.filter(builder=builder).count(), 6)
+
+    def test_reset(self):
+        builder, node, locs = _builder_setup()
+        builder.generate = True
+        builder.save()
+        builder._generate_check()
+        job = BuilderJob.next()
+        ForceVisit.objects.create(node=node, loc=locs[0], builder=builder, datetime=datetime.datetime(2015, 1, 5, 9, 0))
+        self.assertRaises(ValidationError, builder.clean)
+        job.reset()
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        builder.clean() # editable again.
+        self.assertEqual(BuilderJob.objects.get(pk=job.pk).status, 'e')
+        self.assertFalse(builder.generate)
+        self.assertFalse(ForceVisit.objects.filter(builder=builder).exists())
+
+    def test_generate_builders(self):
+        builder, node, locs = _builder_setup()
+        node2 = ForceNode.objects.create(name='node 2', user=node.user)
+        builder2 = VisitBuilder.objects.create(name='builder 2', node=node2)
+        builder2.periods.add(*builder.periods.all())
+        VisitCond.objects.create(builder=builder2).loccats.add(*LocCat.objects.all())
+        call_command('generate_builders', str(builder.id), str(builder2.id), processes=1)
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        builder2 = VisitBuilder.objects.get(pk=builder2.pk)
+        self.assertTrue(builder.generated and builder2.generated)
+        self.assertEqual(builder.qty_visits, 6)
+        self.assertEqual(builder2.qty_visits, 0) # same locs & period, merged after builder.
+        self.assertEqual(builder2.qty_locs_skips, 6)
+        self.assertEqual(builder2.jobs.first().status, 'd')
+
+    def test_simulate(self):
+        builder, node, locs = _builder_setup()
+        v = builder.simulate()
+        self.assertEqual(v['qty_visits'], 6)
+        self.assertEqual(len(v['schedule']), 6)
+        self.assertEqual(v['schedule'][0], dict(loc=locs[0].id, loc_name='loc 0', datetime='2015-01-05 09:00:00', end='2015-01-05 09:45:00'))
+        self.assertEqual([ e['phase'] for e in v['timings'] ], [ 'locs', 'sort', 'onoff', 'conflicts', 'periods' ])
+        self.assertFalse(ForceVisit.objects.exists())
+        builder = VisitBuilder.objects.get(pk=builder.pk)
+        self.assertEqual(builder.qty_visits, None)
+        self.assertFalse(builder.generated)
+
+    def test_orderby(self):
+        builder, node, locs = _builder_setup()
+        state = State.objects.first()
+        city = City.objects.create(name='a city', state=state)
+        area = Area.objects.create(name='z area', city=city, zip=Zip.objects.first())
+        place = Place.objects.create(name='place', address=Address.objects.create(street='place', area=area))
+        locs[4].address = None
+        locs[4].place = place # place address fallback.
+        locs[4].save()
+        builder.orderby = 'country,state,city,area'
+        builder.save()
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            engine = builder._generate_engine(utils.Timer(enabled=False), dryrun=True)
+        self.assertEqual(len([ q for q in queries if 'lab_address' in q['sql'] ]), 1) # locs + address hierarchy, NO query per loc @ sort.
+        self.assertEqual([ e[1].name for e in engine.locs.locs ], [ 'loc 4', 'loc 0', 'loc 1', 'loc 2', 'loc 3', 'loc 5' ])
+
+class AvailabilityTests(LabTestCase):
+
+    def test_segments(self):
+        from .availability import Segments
+        seg = Segments([ (1, 10, 'a'), (5, 8, 'b'), (5, 6, 'c') ]) # latest start wins, on ties the later one.
+        self.assertEqual([ seg.get(x) for x in [ 0, 1, 4, 5, 6, 7, 8, 9, 10, 11 ] ], [ None, 'a', 'a', 'c', 'c', 'b', 'b', 'a', 'a', None ])
+
+    def test_invalidate(self):
+        from . import availability
+        builder, node, locs = _builder_setup()
+        sys = Sys.objects.first()
+        calendar = availability.calendar()
+        dt = datetime.datetime(2015, 1, 5, 9, 0)
+        self.assertTrue(availability.locs_visited(locs, sys)[locs[0].id].ison(calendar, dt))
+        OnOffTime.objects.create(visited_user=locs[0].user, on=False, start=datetime.time(8, 0), end=datetime.time(9, 0))
+        self.assertFalse(availability.locs_visited(locs, sys)[locs[0].id].ison(calendar, dt))
+
+    def test_versioned(self):
+        # shared version, e.g. 2 processes.
+        v1, v2 = utils.Versioned('lab.tests.version'), utils.Versioned('lab.tests.version')
+        v1.get()['k'] = 1
+        v2.get()['k'] = 2
+        v2.invalidate()
+        self.assertEqual(v1.get(), dict())
+        v1.get()['k'] = 1
+        version = v1.version
+        SharedVersion.objects.filter(key='lab.tests.version').delete() # lost, e.g. flushed.
+        self.assertEqual(v1.get(), dict())
+        self.assertNotEqual(v1.version, version)
+        v2.patch(lambda data: data.update(k=2)) # NOT up to date, dropped.
+        self.assertEqual(v2.data, dict())
+        v1.get()['k'] = 1
+        v1.patch(lambda data: data.update(k=3))
+        self.assertEqual(v1.get(), dict(k=3))
+        self.assertEqual(v2.get(), dict())
+
+    def test_on_commit(self):
+        from django.db import connection, transaction
+        calls = []
+        with transaction.atomic(): # the first block, installed @ startup.
+            utils.on_commit(lambda: calls.append('outer'), lambda: calls.append('outer rollback'))
+            try:
+                with transaction.atomic():
+                    utils.on_commit(lambda: calls.append('inner'), lambda: calls.append('inner rollback'))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(calls, [ 'inner rollback' ]) # savepoint rolled back.
+        self.assertEqual(calls, [ 'inner rollback', 'outer' ])
+        self.assertEqual(connection.lab_commit_hooks, [])
+        utils.on_commit(lambda: calls.append('now'))
+        self.assertEqual(calls[-1], 'now') # NOT in an atomic block.
+
+    def test_slots(self):
+        from .slots import SlotExpander
+        builder, node, locs = _builder_setup()
+        week = WeekConfig.objects.first()
+        expander = SlotExpander(datetime.time(0, 45), datetime.time(0, 15))
+        start, end = datetime.date(2015, 1, 3), datetime.date(2015, 1, 6) # sat - tue.
+        self.assertEqual(list(expander.slots(week.id, start, end)), [
+            datetime.datetime(2015, 1, 5, 9, 0), datetime.datetime(2015, 1, 5, 10, 0),
+            datetime.datetime(2015, 1, 6, 9, 0), datetime.datetime(2015, 1, 6, 10, 0),
+        ])
+        self.assertEqual(expander.capacity(week.id, start, end), 4)
+        self.assertEqual(len(expander.days), 1) # same day config for every weekday.
+        self.assertEqual(builder.capacity()[0]['slots'], 10)
+
+class LocQueueTests(LabTestCase):
+
+    def test_take(self):
+        from .engine import LocQueue
+        queue = LocQueue([ 'a', 'b', 'c', 'd', 'e' ])
+        self.assertEqual(queue.take(lambda loc: loc == 'b', lambda loc: loc == 'c'), ('c', 1))
+        queue.park(lambda loc: loc == 'd')
+        self.assertEqual(queue.take(lambda loc: False, lambda loc: loc != 'a'), ('e', 0))
+        queue.unpark()
+        self.assertEqual([ e[1] for e in queue.locs ], [ 'a', 'd' ]) # order kept.
+        self.assertEqual(len(queue), 2)
+
+class EligibilityTests(LabTestCase):
+
+    def test_index(self):
+        from . import eligibility
+        parent = UserCat.objects.create(name='parent')
+        child = UserCat.objects.create(name='child', parent=parent)
+        brick = Brick.objects.create(name='brick')
+        form = Form.objects.create(name='form', scope='visits')
+        form.visits_usercats.add(parent)
+        form2 = Form.objects.create(name='form 2', scope='visits', private=True)
+        form2.visits_bricks.add(brick)
+        index = eligibility.index()
+        self.assertEqual(index.forms_ids('visits', False, visits_usercats=[ child ]), set([ form.id ])) # ancestors.
+        self.assertEqual(index.forms_ids('visits', False, visits_bricks=[ brick.id ]), set())
+        self.assertEqual(index.forms_ids('visits', True, visits_bricks=[ brick.id ]), set([ form2.id ]))
+        form2.visits_usercats.add(child)
+        self.assertTrue(eligibility.index() is index) # patched in place, NOT rebuilt.
+        self.assertEqual(index.forms_ids('visits', True, visits_usercats=[ child ]), set([ form2.id ]))
+        self.assertEqual(index.forms_ids('visits', True, visits_usercats=[ parent ]), set())
+        child.parent = None
+        child.save()
+        self.assertEqual(eligibility.index().forms_ids('visits', False, visits_usercats=[ child ]), set())
+
+    def test_commit(self):
+        from . import eligibility, trees
+        from django.db import transaction
+        usercat = UserCat.objects.create(name='usercat')
+        index = eligibility.index()
+        try:
+            with transaction.atomic():
+                form = Form.objects.create(name='form', scope='visits')
+                form.visits_usercats.add(usercat)
+                self.assertEqual(index.forms_ids('visits', False, visits_usercats=[ usercat ]), set()) # NOT until commit.
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(eligibility.index() is index)
+        self.assertEqual(index.forms_ids('visits', False, visits_usercats=[ usercat ]), set()) # rolled back, NOT patched.
+        with transaction.atomic():
+            form = Form.objects.create(name='form', scope='visits')
+            form.visits_usercats.add(usercat)
+        self.assertTrue(eligibility.index() is index)
+        self.assertEqual(index.forms_ids('visits', False, visits_usercats=[ usercat ]), set([ form.id ])) # patched on commit.
+        usercatid = usercat.id
+        try:
+            with transaction.atomic():
+                usercat.delete()
+                self.assertIsNone(trees.get(UserCat).get(usercatid)) # dropped, this process sees its own rows.
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertIsNotNone(trees.get(UserCat).get(usercatid)) # dropped again on rollback.
+
+    def test_items_visible(self):
+        from . import eligibility
+        parent = UserCat.objects.create(name='parent')
+        child = UserCat.objects.create(name='child', parent=parent)
+        loccat = LocCat.objects.create(name='loccat')
+        item = Item.objects.create(name='item')
+        item.visits_usercats.add(parent)
+        item2 = Item.objects.create(name='item 2')
+        index = eligibility.index()
+        self.assertEqual(index.items_visible([ child ], [ loccat ]), set([ item.id ])) # ancestors.
+        item2.visits_loccats.add(loccat)
+        self.assertTrue(eligibility.index() is index)
+        self.assertEqual(index.items_visible([ child ], [ loccat ]), set([ item.id, item2.id ]))
+        self.assertEqual(index.items_visible([], [ loccat.id ]), set([ item2.id ]))
+        itemcat = ItemCat.objects.create(name='itemcat')
+        form = Form.objects.create(name='form')
+        form.repitemcats.add(itemcat)
+        self.assertEqual(index.form_reps(form), [])
+        item2.cats.add(itemcat)
+        self.assertEqual(eligibility.index().form_reps(form), [ item2 ])
+
+    def test_forms_reps_many(self):
+        builder, node, locs = _builder_setup()
+        loccat = LocCat.objects.first()
+        itemcat = ItemCat.objects.create(name='itemcat')
+        node.itemcats.add(itemcat)
+        item = Item.objects.create(name='item')
+        item.cats.add(itemcat)
+        item.visits_loccats.add(loccat)
+        form = Form.objects.create(name='form', scope='visits')
+        form.visits_loccats.add(loccat)
+        form.repitemcats.add(itemcat)
+        Form.objects.create(name='form 2', scope='visits').visits_usercats.add(UserCat.objects.create(name='usercat'))
+        visits = [ ForceVisit.objects.create(node=node, loc=loc, datetime=datetime.datetime(2015, 1, 5, 9, i)) for i, loc in enumerate(locs[:2] + locs[:1]) ]
+        many = Form.get_forms_reps_many(visits)
+        self.assertEqual(many[visits[0].id], ([], [], { item.id: [ form.id ] }, {})) # form only @ reps, as it has rep items.
+        for visit in visits:
+            ctx = node.visits_data()
+            self.assertEqual(many[visit.id], Form.get_forms_reps(baseuser=visit.loc.user, visit=visit, usercats=visit.loc.user.cats.all(), loccats=visit.loc.cats.all(), **ctx))
+
+    def test_nodes(self):
+        from . import nodes
+        root = ForceNode.objects.create(name='root')
+        node = ForceNode.objects.create(name='node', parent=root)
+        node2 = ForceNode.objects.create(name='node 2', parent=root)
+        itemcat = ItemCat.objects.create(name='itemcat')
+        root.itemcats.add(itemcat)
+        d = nodes.get(node)
+        self.assertEqual([ e.name for e in d['upnodes'] ], [ 'root', 'node' ])
+        self.assertEqual(d['items'], [])
+        with utils.versions_scope(), self.assertNumQueries(1): # shared versions only, once per request.
+            self.assertTrue(nodes.get(node) is d)
+        Item.objects.create(name='item').cats.add(itemcat) # invalidated.
+        self.assertEqual([ e.name for e in nodes.get(node)['items'] ], [ 'item' ])
+        with self.settings(LAB_NODES_CACHE=1):
+            nodes.get(node2)
+            self.assertEqual(list(nodes._cached.data['nodes'].keys()), [ node2.id ]) # evicted.
+
+class PayloadsTests(LabTestCase):
+
+    def test_agenda(self):
+        from django.test.client import RequestFactory
+        from . import views
+        builder, node, locs = _builder_setup()
+        visits = [ ForceVisit.objects.create(node=node, loc=loc, datetime=datetime.datetime(2015, 1, 5, 9, i)) for i, loc in enumerate(locs[:3]) ]
+        request = RequestFactory().get('/lab/agenda')
+        data = views._data(request, dict(node=node))
+        self.assertEqual(sorted(data['visits'].keys()), [ visit.id for visit in visits ])
+        with utils.versions_scope(), self.assertNumQueries(5): # node visit ids, shared versions & fragments (user, visits at once, catalog).
+            self.assertEqual(views._data(request, dict(node=node)), data)
+        locs[0].user.last_login = datetime.datetime(2015, 1, 5)
+        locs[0].user.save(update_fields=[ 'last_login' ]) # a login, NOT read.
+        builder.conds.first().loccats.clear() # NOT read either.
+        with utils.versions_scope(), self.assertNumQueries(5):
+            self.assertEqual(views._data(request, dict(node=node)), data)
+        more = [ ForceVisit.objects.create(node=node, loc=loc, datetime=datetime.datetime(2015, 1, 6, 9, i)) for i, loc in enumerate(locs[3:]) ]
+        views._data(request, dict(node=node))
+        with utils.versions_scope(), self.assertNumQueries(5): # same, NOT per visit.
+            self.assertEqual(len(views._data(request, dict(node=node))['visits']), len(visits + more))
+        visits[1].observations = 'edited'
+        visits[1].save()
+        data2 = views._data(request, dict(node=node))
+        self.assertEqual(data2['visits'][visits[1].id]['observations'], 'edited') # only this one re-rendered.
+        self.assertEqual(data2['visits'][visits[0].id], data['visits'][visits[0].id])
+        self.assertEqual(views._data(request, dict(visit=visits[1])), data2['visits'][visits[1].id])
+        locs[0].user.first_name = 'renamed'
+        locs[0].user.save() # data version bumped, all re-rendered.
+        self.assertNotEqual(views._data(request, dict(node=node))['visits'][visits[0].id], data['visits'][visits[0].id])
+
+    def test_rollback(self):
+        from django.db import transaction
+        from django.test.client import RequestFactory
+        from . import views
+        builder, node, locs = _builder_setup()
+        visit = ForceVisit.objects.create(node=node, loc=locs[0], datetime=datetime.datetime(2015, 1, 5, 9, 0))
+        request = RequestFactory().get('/lab/agenda')
+        data = views._data(request, dict(visit=visit))
+        try:
+            with transaction.atomic():
+                visit.observations = 'edited'
+                visit.save()
+                locs[0].user.first_name = 'renamed'
+                locs[0].user.save()
+                self.assertEqual(views._data(request, dict(visit=visit))['observations'], 'edited') # cached, NOT committed.
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(views._data(request, dict(visit=ForceVisit.objects.get(pk=visit.pk))), data) # dropped on rollback.
+
+    def test_prep_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        builder, node, locs = _builder_setup()
+        for i, loc in enumerate(locs):
+            loc.user.cats.add(UserCat.objects.create(name='usercat %s' % i))
+        form = Form.objects.create(name='form', scope='visits')
+        form.visits_loccats.add(LocCat.objects.first())
+        visits = [ ForceVisit.objects.create(node=node, loc=loc, datetime=datetime.datetime(2015, 1, 5, 9, i)) for i, loc in enumerate(locs) ]
+        def _prep(ids):
+            with CaptureQueriesContext(connection) as queries: # NOT @ a request.
+                visits = list(ForceVisit.prep_queryset().filter(id__in=ids))
+                reps = Form.get_forms_reps_many(visits)
+                preps = [ (repr(visit), visit.prep(False, reps=reps[visit.id])) for visit in visits ]
+            self.assertEqual(len(preps), len(ids))
+            return len(queries)
+        _prep([ visits[0].id ]) # caches (trees, eligibility, nodes) loaded.
+        self.assertEqual(_prep([ visit.id for visit in visits[:2] ]), _prep([ visit.id for visit in visits ])) # NOT per visit.
+        self.assertEqual(_prep([ visit.id for visit in visits ]), 6) # shared versions, visits, user cats, loc cats, forms & form types.
+
+    def test_catalog(self):
+        from django.test.client import Client
+        import json
+        form = Form.objects.create(name='form')
+        response = Client().get('/lab/catalog')
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content)['allforms'].keys(), [ str(form.id) ])
+        self.assertIn('must-revalidate', response['Cache-Control'])
+        response = Client().get('/lab/catalog', dict(v=etag.strip('"')), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        FormField.objects.create(form=form, name='field')
+        self.assertNotEqual(Client().get('/lab/catalog')['ETag'], etag)
+
+class TreeTests(LabTestCase):
+
+    def test_algebra(self):
+        a = UserCat.objects.create(name='a')
+        for name, parent in [ ('a1', a), ('a2', a), ('b', None) ]:
+            UserCat.objects.create(name=name, parent=parent)
+        UserCat.objects.create(name='a11', parent=UserCat.objects.get(name='a1'))
+        cats = dict([ (cat.name, cat) for cat in UserCat.objects.all() ]) # reloaded, lft / rght after rebuilds.
+        def _names(nodes):
+            return sorted([ node.name for node in nodes ])
+        utils.version_get('lab.trees.version.UserCat') # shared version created.
+        with utils.versions_scope(), self.assertNumQueries(2): # shared versions & tree cache, loaded once.
+            self.assertEqual(_names(utils.tree_all_downs([ cats['a'], cats['a1'] ])), [ 'a', 'a1', 'a11', 'a2' ])
+            self.assertEqual(_names(utils.tree_ups(cats['a11'])), [ 'a', 'a1', 'a11' ])
+        self.assertEqual(utils.tree_all_downs([]), set())
+        UserCat.objects.create(name='a3', parent=cats['a']) # invalidated.
+        self.assertEqual(_names(utils.tree_downs(cats['a'])), [ 'a', 'a1', 'a11', 'a2', 'a3' ])
+
+    def test_incremental(self):
+        def _tree():
+            return list(LocCat.objects.order_by('tree_id', 'lft').values_list('name', 'parent__name', 'tree_id', 'lft', 'rght', 'level'))
+        def _rebuilt():
+            v = _tree()
+            LocCat.objects.rebuild()
+            self.assertEqual(v, _tree()) # same as a full rebuild.
+            return [ e[0] for e in v ]
+        root = LocCat.objects.create(name='root')
+        for name in [ 'c', 'a', 'b' ]:
+            LocCat.objects.create(name=name, parent=root) # root is stale after the first one.
+        self.assertEqual(_rebuilt(), [ 'root', 'a', 'b', 'c' ]) # order_insertion_by.
+        a = LocCat.objects.get(name='a')
+        a.name = 'd'
+        a.save()
+        self.assertEqual(_rebuilt(), [ 'root', 'b', 'c', 'd' ])
+        b = LocCat.objects.get(name='b')
+        b.parent = LocCat.objects.get(name='c')
+        b.save()
+        self.assertEqual(_rebuilt(), [ 'root', 'c', 'b', 'd' ])
+        with LocCat.deferred():
+            for name in [ 'z', 'y' ]:
+                LocCat.objects.create(name=name, parent=root)
+            LocCat.objects.create(name='x root')
+        self.assertEqual(_rebuilt(), [ 'root', 'c', 'b', 'd', 'y', 'z', 'x root' ])
+        self.assertEqual(sorted([ e.name for e in utils.tree_downs(LocCat.objects.get(name='c')) ]), [ 'b', 'c' ])
+
+def _api_setup():
+    builder, node, locs = _builder_setup()
+    for model in [ GenericCat, PeriodCat, UserCat, ItemCat, PlaceCat, FormCat ]:
+        model.objects.create(name='child', parent=model.objects.create(name='root'))
+    loc = locs[0]
+    loc.user.cats.add(UserCat.objects.first())
+    Place.objects.create(name='place', address=loc.address).cats.add(PlaceCat.objects.first())
+    item = Item.objects.create(name='item')
+    item.cats.add(ItemCat.objects.first())
+    item.visits_usercats.add(UserCat.objects.first())
+    form = Form.objects.create(name='form')
+    form.types.add(FormType.objects.create(name='type'))
+    form.cats.add(FormCat.objects.first())
+    form.repitems.add(item)
+    FormField.objects.create(form=form, name='field', optscat=GenericCat.objects.first())
+    UserFormRec.objects.create(user=loc.user, form=form)
+    ForceVisit.objects.create(node=node, loc=loc, builder=builder)
+    OnOffPeriod.objects.create(visited_loc=loc, start=datetime.date(2015, 1, 5), end=datetime.date(2015, 1, 6))
+    OnOffTime.objects.create(visit_user=loc.user, start=datetime.time(9, 0), end=datetime.time(10, 0))
+
+_clones = itertools.count()
+
+def _clone(row):
+    # a copy of row (new pk), its unique fields / relations (one to one, unique together) made unique too, m2m included.
+    model = row.__class__
+    clone = model.objects.get(pk=row.pk)
+    together = set(utils.list_flatten(model._meta.unique_together, lambda fnames: fnames))
+    for f in model._meta.fields:
+        v = getattr(clone, f.name)
+        if f.primary_key or not v:
+            continue
+        if isinstance(f, models.OneToOneField) or (f.name in together and isinstance(f, models.ForeignKey)):
+            setattr(clone, f.name, _clone(v))
+        elif (f.unique or f.name in together) and isinstance(f, models.CharField):
+            setattr(clone, f.name, 'clone %s %s' % (next(_clones), v))
+    clone.pk = None
+    clone.save()
+    for f in model._meta.many_to_many:
+        if f.rel.through._meta.auto_created: # NOT e.g. visits (ForceVisit rows, cloned on their own).
+            getattr(clone, f.name).add(*getattr(row, f.name).all())
+    return clone
+
+class ApiTests(LabTestCase):
+
+    # query budget per list endpoint: session & user, count & rows, plus one per many relation (prefetch), NOT per row.
+    _budget_extra = dict()
+
+    def _login(self):
+        User.objects.create_superuser('admin@go.com', 'pwd')
+        self.client.login(email='admin@go.com', password='pwd')
+
+    def test_budgets(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from . import api
+        _api_setup()
+        self._login()
+        registry = [ (prefix, viewset) for prefix, viewset, base_name in api.router.registry if self._budget_extra.get(prefix, 0) is not None ]
+        def _queries(prefix):
+            self.client.get('/lab/api/%s/' % prefix) # warm up, e.g. process caches.
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/lab/api/%s/' % prefix)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+        few = dict()
+        for prefix, viewset in registry:
+            self.assertTrue(viewset.queryset.exists(), prefix) # rows to serialize.
+            few[prefix] = _queries(prefix)
+            manys = api._related(viewset.serializer_class().fields)[1]
+            self.assertLessEqual(few[prefix], 4 + len(manys) + self._budget_extra.get(prefix, 0), prefix)
+        counts = dict([ (prefix, viewset.queryset.count()) for prefix, viewset in registry ])
+        for row in utils.list_flatten(registry, lambda (prefix, viewset): list(viewset.queryset.all())):
+            _clone(row)
+            _clone(row)
+        for prefix, viewset in registry:
+            self.assertGreaterEqual(viewset.queryset.count(), 3 * counts[prefix], prefix)
+            self.assertEqual(_queries(prefix), few[prefix], prefix) # same as with fewer rows, NOT per row (N+1).
+
+    def test_expand(self):
+        import json
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        builder, node, locs = _builder_setup()
+        self._login()
+        visit = ForceVisit.objects.create(node=node, loc=locs[0])
+        def _get(params):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/lab/api/forcevisits/', params)
+            return json.loads(response.content)['results'], len(queries)
+        results, n = _get(dict())
+        self.assertNotIn('get_prep_public', results[0]) # opt-in.
+        _get(dict(expand='prep')) # caches (trees, eligibility, nodes) loaded.
+        results, n = _get(dict(expand='prep'))
+        self.assertEqual(json.loads(results[0]['get_prep_private']), json.loads(visit.get_prep_private()))
+        for loc in locs[1:]:
+            ForceVisit.objects.create(node=node, loc=loc)
+        results, n2 = _get(dict(expand='prep'))
+        self.assertEqual(len(results), len(locs))
+        self.assertEqual(n2, n) # page at once, NOT per visit.
+        results, n = _get(dict(fields='id,get_prep_public'))
+        self.assertEqual(sorted(results[0].keys()), [ 'get_prep_public', 'id' ])
+
+    def test_sparse(self):
+        import json
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        _api_setup()
+        self._login()
+        def _get(params):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/lab/api/areas/', params)
+            return json.loads(response.content)['results'][0], [ query['sql'] for query in queries.captured_queries if 'lab_area' in query['sql'] ]
+        row, sqls = _get(dict())
+        self.assertIn('city__url', row)
+        self.assertIn('JOIN', sqls[-1])
+        row, sqls = _get(dict(links=0))
+        self.assertEqual(sorted(row.keys()), [ 'city', 'id', 'name', 'syscode', 'zip' ])
+        self.assertNotIn('JOIN', sqls[-1]) # NO city / zip joins, ids only.
+        row, sqls = _get(dict(omit='syscode,zip,zip__url', links=0))
+        self.assertEqual(sorted(row.keys()), [ 'city', 'id', 'name' ])
+
+    def test_cursor(self):
+        import json
+        from . import api
+        builder, node, locs = _builder_setup()
+        self._login()
+        dt = datetime.datetime(2015, 1, 5, 9, 0, 0, 123456)
+        visits = [ ForceVisit.objects.create(node=node, loc=loc, datetime=dt if i < 3 else dt + datetime.timedelta(hours=i)) for i, loc in enumerate(locs) ] # ties @ datetime.
+        ids = []
+        pages = 0
+        url = '/lab/api/forcevisits/?cursor=&links=0'
+        api.ForceVisitViewSet.paginate_by = 2 # page ends @ a datetime tie.
+        try:
+            while url:
+                data = json.loads(self.client.get(url).content)
+                self.assertNotIn('count', data)
+                ids.extend([ row['id'] for row in data['results'] ])
+                url = data['next']
+                pages += 1
+        finally:
+            del api.ForceVisitViewSet.paginate_by
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, [ visit.id for visit in visits ]) # (datetime, id) order, NO gaps / repeats.
+        data = json.loads(self.client.get('/lab/api/forcevisits/', dict(cursor='', count=1, loc=locs[0].id)).content)
+        self.assertEqual((data['count'], len(data['results']), data['next']), (1, 1, None))
+        self.assertEqual(self.client.get('/lab/api/locs/', dict(cursor='x')).status_code, 400)
+
+    def test_export(self):
+        import csv, json
+        from . import api
+        builder, node, locs = _builder_setup()
+        self._login()
+        visits = [ ForceVisit.objects.create(node=node, loc=loc, datetime=datetime.datetime(2015, 1, 5, 9, i), observations=u'caf\xe9 %s' % i) for i, loc in enumerate(locs) ]
+        api.ForceVisitViewSet.export_chunk = 4
+        try:
+            response = self.client.get('/lab/api/forcevisits/export/', dict(links=0, starts='2015-01-05 09:01'))
+            rows = [ json.loads(line) for line in ''.join(response.streaming_content).splitlines() ]
+            response = self.client.get('/lab/api/forcevisits/export/', { 'as': 'csv', 'fields': 'id,observations' })
+            lines = list(csv.reader(''.join(response.streaming_content).splitlines()))
+        finally:
+            del api.ForceVisitViewSet.export_chunk
+        self.assertEqual([ row['id'] for row in rows ], [ visit.id for visit in visits[1:] ]) # filtered, across chunks.
+        self.assertNotIn('url', rows[0])
+        self.assertEqual(lines[0], [ 'id', 'observations' ])
+        self.assertEqual(lines[1], [ str(visits[0].id), u'caf\xe9 0'.encode('utf-8') ])
+        self.assertEqual(len(lines), len(visits) + 1)
+        UserFormRec.objects.create(user=locs[0].user, form=Form.objects.create(name='form'))
+        response = self.client.get('/lab/api/userformrecs/export/', dict(user=locs[0].user.id))
+        self.assertEqual(len(''.join(response.streaming_content).splitlines()), 1)
@@ -0,0 +1,79 @@
+from django.db.models.signals import post_save, post_delete
+
+from collections import defaultdict
+
+from .models import *
+
+import utils
+
+'''
+Process-wide cache of the AbstractTree models (small & hot: cats, places, force nodes), one per model:
+nodes, children and precomputed ancestor / descendant ids,
+so tree walks (utils.tree_*) need NO queries. Nodes are shared, so they must NOT be modified.
+Each model cache is dropped when its shared version (cache backend) changes, bumped by the signals below.
+'''
+
+class TreeCache(object):
+
+    def __init__(self, model):
+        self.model = model
+        nodes = sorted(model._default_manager.all(), key=lambda node: (node.tree_id, node.lft))
+        self.nodes = dict([ (node.id, node) for node in nodes ])
+        self.order = dict([ (node.id, i) for i, node in enumerate(nodes) ]) # tree order.
+        self.children = defaultdict(list)
+        self.ups = dict() # id => ancestor ids (root first), itself included.
+        self.downs = defaultdict(set) # id => descendant ids, itself included.
+        for node in nodes: # parents before children.
+            ups = self.ups.get(node.parent_id, ()) + (node.id,)
+            self.ups[node.id] = ups
+            for eid in ups:
+                self.downs[eid].add(node.id)
+            if node.parent_id:
+                self.children[node.parent_id].append(node.id)
+
+    def _nodes(self, ids):
+        return [ self.nodes[eid] for eid in sorted(ids, key=self.order.get) if eid in self.nodes ]
+
+    def _ids(self, nodes):
+        return [ getattr(each, 'id', each) for each in nodes ]
+
+    def get(self, nodeid):
+        return self.nodes.get(nodeid)
+
+    def node_ups(self, node):
+        return self._nodes(self.ups.get(getattr(node, 'id', node), ()))
+
+    def node_downs(self, node, include_self=True):
+        nodeid = getattr(node, 'id', node)
+        return self._nodes([ eid for eid in self.downs.get(nodeid, ()) if include_self or eid != nodeid ])
+
+    def node_children(self, node):
+        return self._nodes(self.children.get(getattr(node, 'id', node), ()))
+
+    def downs_ids(self, nodes):
+        return set(utils.list_flatten(self._ids(nodes), lambda eid: self.downs.get(eid, ())))
+
+    def all_downs(self, nodes):
+        return set(self._nodes(self.downs_ids(nodes)))
+
+
+
+_cached = dict() # model => utils.Versioned, its TreeCache.
+
+def _versioned(model):
+    if model not in _cached:
+        _cached[model] = utils.Versioned('lab.trees.version.%s' % model.__name__)
+    return _cached[model]
+
+def get(model):
+    data = _versioned(model).get()
+    if 'tree' not in data:
+        data['tree'] = TreeCache(model)
+    return data['tree']
+
+def invalidate(sender, **kwargs):
+    _versioned(sender).invalidate()
+
+for _model in AbstractTree.__subclasses__():
+    post_save.connect(invalidate, sender=_model, dispatch_uid='lab.trees.%s.save' % _model.__name__)
+    post_delete.connect(invalidate, sender=_model, dispatch_uid='lab.trees.%s.delete' % _model.__name__)
@@ -6,6 +6,7 @@ urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
     url(r'^setup$', views.setup, name='setup'),
     url(r'^agenda$', views.agenda, name='agenda'),
+    url(r'^catalog$', views.catalog, name='catalog'),
     url(r'^ajax$', views.ajax, name='ajax'),
 
     url(r'^goauth$', views.goauth, name='goauth'),
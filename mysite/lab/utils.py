@@ -1,5 +1,9 @@
 from django.core.exceptions import ValidationError
+from contextlib import contextmanager
 import datetime
+import random
+import threading
+import time
 
 weekdays = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
 
@@ -20,6 +24,9 @@ def str_int(string):
 def str_ints(string, separator=','):
     return list_compact([ str_int(e) for e in string.split(separator) ])
 
+def str_list(string, separator=','):
+    return list_compact([ e.strip() for e in (string or '').split(separator) ])
+
 def db_models():
     from django.db.models import get_app, get_models
     app = get_app('lab')
@@ -72,20 +79,26 @@ def validate_X(data):
     if not isvalid:
         return 'Error: Incompatible Engine.'
 
+'''
+Tree algebra over whole sets of nodes, from the process-wide tree cache (lab.trees: precomputed ancestor / descendant ids),
+NO queries: closures here, e.g. VisitCond.qn & the api cats filter (one IN over the closure ids).
+"Any overlap" of cat sets (e.g. form eligibility, formerly tree_any per form) is the lab.eligibility index instead,
+ancestor closures per cat, so NO per form / per set interval checks (MPTT lft / rght ranges) are needed.
+'''
+
+def _tree(node):
+    from lab import trees # NOT at the top, lab.models imports utils.
+    return trees.get(node.__class__)
+
 def tree_ups(node):
-    return node.get_ancestors(include_self=True)
+    return _tree(node).node_ups(node)
 
 def tree_downs(node):
-    return node.get_descendants(include_self=True)
-
-def tree_any(n1, n2, ups=True):
-    if ups:
-        n1 = list_flatten(n1, lambda ex: tree_ups(ex))
-    # print 'tree_any', n1, n2
-    return any( [ each for each in n1 if each in n2.all() ] )
+    return _tree(node).node_downs(node)
 
 def tree_all_downs(cats):
-    return set(list_flatten(cats, lambda ecat: tree_downs(ecat)))
+    cats = list(cats)
+    return _tree(cats[0]).all_downs(cats) if cats else set()
 
 def validate_one(list, msg):
     # print 'validate_one', list, msg
@@ -125,3 +138,207 @@ def datetime_plus(dt, *durations):
         hours = _sum('hour'),
         minutes = _sum('minute'),
     )
+
+class Timer(object):
+
+    # accumulated seconds per phase, does nothing when NOT enabled (so it can be always passed around).
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = dict()
+        self.order = []
+
+    def add(self, name, secs):
+        if name not in self.phases:
+            self.order.append(name)
+            self.phases[name] = 0
+        self.phases[name] += secs
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.add(name, time.time() - t0)
+
+    def wrap(self, name, fn):
+        if not self.enabled:
+            return fn
+        def _fn(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - t0)
+        return _fn
+
+    def wrap_iter(self, name, els):
+        if not self.enabled:
+            return els
+        def _iter():
+            it = iter(els)
+            while True:
+                t0 = time.time()
+                try:
+                    each = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    self.add(name, time.time() - t0)
+                yield each
+        return _iter()
+
+    def report(self):
+        return [ dict(phase=name, secs=round(self.phases[name], 6)) for name in self.order ]
+
+
+
+def _atomic_exit(exit):
+    # runs the on_commit hooks once the outermost block committed (autocommit back on), their rollbacks if rolled back,
+    # and as soon as a savepoint rolls back for the hooks registered within it.
+    def __exit__(self, exc_type, exc_value, traceback):
+        from django.db import transaction
+        connection = transaction.get_connection(self.using)
+        depth = len(connection.savepoint_ids) # 0 @ the outermost block.
+        ok = exc_type is None and not connection.needs_rollback and not connection.closed_in_transaction
+        try:
+            exit(self, exc_type, exc_value, traceback)
+        except:
+            ok = False
+            raise
+        finally:
+            hooks = getattr(connection, 'lab_commit_hooks', [])
+            if not connection.in_atomic_block:
+                connection.lab_commit_hooks = []
+                run = [ fn if ok else rollback for fn, rollback, hdepth in hooks ]
+            elif not ok:
+                connection.lab_commit_hooks = [ hook for hook in hooks if hook[2] < depth ]
+                run = [ rollback for fn, rollback, hdepth in hooks if hdepth >= depth ]
+            else:
+                run = []
+            for fn in run:
+                if fn:
+                    fn()
+    return __exit__
+
+def on_commit_install():
+    # @ LabConfig.ready, i.e. before any atomic block is entered: Atomic.__exit__ is looked up when a block is entered.
+    from django.db import transaction
+    if not getattr(transaction.Atomic, 'lab_on_commit', False):
+        transaction.Atomic.__exit__ = _atomic_exit(transaction.Atomic.__exit__)
+        transaction.Atomic.lab_on_commit = True
+
+def on_commit(fn, rollback=None, using=None):
+    # Django 1.7 has NO transaction.on_commit (1.9+): fn runs after the outermost atomic block commits, rollback (if any) instead if rolled back.
+    # e.g. so other processes do NOT rebuild from (or keep) uncommitted rows. Now if NOT in an atomic block (autocommit).
+    from django.db import transaction
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        fn()
+        return
+    if not getattr(transaction.Atomic, 'lab_on_commit', False):
+        raise RuntimeError('on_commit NOT installed, see LabConfig.ready.')
+    if not hasattr(connection, 'lab_commit_hooks'):
+        connection.lab_commit_hooks = []
+    connection.lab_commit_hooks.append((fn, rollback, len(connection.savepoint_ids)))
+
+_random = random.SystemRandom() # NOT the global random, e.g. seeded @ simulations.
+
+# shared versions (lab.models.SharedVersion), read once per request / job (see versions_scope), every call outside;
+# start random, so a lost row (e.g. flushed tables) never matches stale data keyed / built by the previous one.
+
+_versions = threading.local()
+
+def _versions_memo():
+    # key => version, loaded at once, None if NOT @ a versions_scope.
+    from lab.models import SharedVersion
+    if not getattr(_versions, 'scoped', False):
+        return None
+    if _versions.memo is None:
+        _versions.memo = dict(SharedVersion.objects.values_list('key', 'version'))
+    return _versions.memo
+
+def version_get(key):
+    from lab.models import SharedVersion
+    memo = _versions_memo()
+    if memo is None:
+        memo = dict(SharedVersion.objects.filter(key=key).values_list('key', 'version'))
+    if key not in memo:
+        memo[key] = SharedVersion.objects.get_or_create(key=key, defaults=dict(version=_random.getrandbits(62)))[0].version
+    return memo[key]
+
+def version_bump(key):
+    # atomic, concurrent bumps never collapse into one: the version read back is old + 1 only if NO other bump since.
+    from django.db.models import F
+    from lab.models import SharedVersion
+    rows = SharedVersion.objects.filter(key=key)
+    version = rows.values_list('version', flat=True).first() if rows.update(version=F('version') + 1) else None # NOT set yet.
+    memo = _versions_memo()
+    if memo is not None:
+        memo.pop(key, None)
+        if version is not None:
+            memo[key] = version
+    return version
+
+def versions_begin(**kwargs):
+    _versions.scoped = True
+    _versions.memo = None
+
+def versions_end(**kwargs):
+    _versions.scoped = False
+    _versions.memo = None
+
+@contextmanager
+def versions_scope():
+    # e.g. a builder job, as requests (request_started / finished @ LabConfig.ready), the outermost one only.
+    if getattr(_versions, 'scoped', False):
+        yield
+        return
+    versions_begin()
+    try:
+        yield
+    finally:
+        versions_end()
+
+class Versioned(object):
+
+    # process local data (dict), dropped when its shared version (see version_get) changes, i.e. changed @ any process.
+
+    def __init__(self, key):
+        self.key = key
+        self.version = None
+        self.data = dict()
+
+    def _drop(self):
+        self.version = None
+        self.data = dict()
+
+    def get(self):
+        version = version_get(self.key)
+        if version != self.version:
+            self._drop()
+            self.version = version
+        return self.data
+
+    def invalidate(self):
+        # bumped @ on_commit, so other processes do NOT rebuild from uncommitted rows.
+        # dropped now too (this process sees its own rows), and again on rollback (e.g. ids re-used @ SQLite).
+        def _invalidate():
+            version_bump(self.key)
+            self._drop()
+        self._drop()
+        on_commit(_invalidate, self._drop)
+
+    def patch(self, fn):
+        # fn(data) patches the local data in place, only if up to date (i.e. NO changes by other processes since), otherwise dropped.
+        # @ on_commit, fn must re-read the rows (committed by then), NOT patched until then (nothing to undo on rollback).
+        def _patch():
+            version = version_bump(self.key)
+            if self.version is not None and version == self.version + 1:
+                fn(self.data)
+                self.version = version
+            else:
+                self._drop()
+        on_commit(_patch)
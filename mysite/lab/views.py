@@ -1,5 +1,5 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.db import IntegrityError, transaction
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse_lazy
@@ -8,6 +8,7 @@ from decimal import Decimal
 import json
 
 from .models import *
+from . import payloads
 
 import utils
 
@@ -19,21 +20,68 @@ def setup(request):
     import setup_db
     return HttpResponse(setup_db.setup())
 
+def _all(model):
+    return model.objects.all()
+
+def _ext(db1, d2):
+    d2.update(
+        id = db1.id,
+        full = repr(db1), # NO str, otherwise DjangoUnicodeDecodeError if special chars (e.g. accents).
+    )
+    return d2
+
+def _dict(dbn, fn):
+    return dict([ (each.id, _ext(each, fn(each)))
+        for each in dbn ])
+
+def _catalog():
+    allitems = _all(Item)
+    allusercats = _all(UserCat)
+    allformtypes = _all(FormType)
+    allforms = Form.objects.order_by('order', 'name').all()
+    def _types(row):
+        types = row.types.all()
+        # return _dict(types, lambda field: dict())
+        return utils.db_ids(types)
+    def _reps(reps):
+        return _dict(reps, lambda erep: dict(
+            name = erep.name,
+            description = erep.forms_description,
+            expandable = erep.forms_expandable,
+            order = erep.forms_order,
+        ))
+    return dict(
+        allitems = _reps(allitems),
+        allusercats = _reps(allusercats),
+        allformtypes = _dict(allformtypes, lambda ftype: dict(
+            name = ftype.name,
+            description = ftype.description,
+            order = ftype.order,
+        )),
+        allforms = _dict(allforms, lambda form: dict(
+            name = form.name,
+            description = form.description,
+            expandable = form.expandable,
+            order = form.order,
+            fields = _dict(form.fields.all(), lambda field: dict(
+                name = field.name,
+                description = field.description,
+                type = field.type,
+                widget = field.widget,
+                default = field.default,
+                required = field.required,
+                order = field.order,
+                opts = field.opts(),
+                types = _types(field),
+            )),
+            types = _types(form),
+        )),
+    )
+
 def _data(request, config=None):
     # print '_data', config
-    def _all(model):
-        return model.objects.all()
     def _list(model):
         return [ config.get(model) ] if config else _all(model)
-    def _ext(db1, d2):
-        d2.update(
-            id = db1.id,
-            full = repr(db1), # NO str, otherwise DjangoUnicodeDecodeError if special chars (e.g. accents).
-        )
-        return d2
-    def _dict(dbn, fn):
-        return dict([ (each.id, _ext(each, fn(each)))
-            for each in dbn ])
     private = bool(utils.str_int(request.GET.get('private')))
     # print '_data.private', private
     data = None
@@ -55,78 +103,48 @@ def _data(request, config=None):
     # print '_data > *', visit, go_user, go_nodes
     if True: # previous [ if go_nodes: ] REMOVED in order for user forms (without nodes) @ agenda to work properly.
 
-        def _visit(visit, ext=False):
-            v = visit.prep(private)
+        # sections cached @ lab.payloads: visits (per visit), user, catalog (version only, see catalog).
+
+        def _visit(visit, ext=False, reps=None):
+            v = visit.prep(private, reps=reps)
             if ext:
                 _ext(visit, v)
             return v
 
+        def _visits(ids):
+            # missing visits only, forms of all of them at once.
+            visits = list(ForceVisit.prep_queryset().filter(id__in=ids))
+            reps = Form.get_forms_reps_many(visits, private)
+            return dict([ (visit.id, _visit(visit, ext=True, reps=reps[visit.id])) for visit in visits ])
+
+        def _user():
+            formtypes, forms_ids, repdict_items_ids, repdict_usercats_ids = go_user.get_forms_reps(private=private)
+            formids = forms_ids + repdict_items_ids.keys() + repdict_usercats_ids.keys()
+            recs = UserFormRec.objects.filter(form__in=formids)
+            recdict = dict([ (rec.form.id, rec.jsrec()) for rec in recs ])
+            user_dict = dict(
+                id = go_user.id,
+                name = go_user.fullname(),
+                formtypes = formtypes,
+                forms = forms_ids,
+                repdict_items = repdict_items_ids,
+                repdict_usercats = repdict_usercats_ids,
+                recs = recdict,
+            )
+            # print 'user_dict', user_dict
+            return user_dict
+
         if visit:
-            data = _visit(visit, ext=True)
+            data = payloads.visits([ visit.id ], private, _visits)[visit.id]
         else:
-            visits = utils.list_flatten(go_nodes, lambda node: node.visits.all())
-            allitems = _all(Item)
-            allusercats = _all(UserCat)
-            allformtypes = _all(FormType)
-            allforms = Form.objects.order_by('order', 'name').all()
-            user_dict = None
-            if go_user:
-                formtypes, forms_ids, repdict_items_ids, repdict_usercats_ids = go_user.get_forms_reps(private=private)
-                formids = forms_ids + repdict_items_ids.keys() + repdict_usercats_ids.keys()
-                recs = UserFormRec.objects.filter(form__in=formids)
-                recdict = dict([ (rec.form.id, rec.jsrec()) for rec in recs ])
-                user_dict = dict(
-                    id = go_user.id,
-                    name = go_user.fullname(),
-                    formtypes = formtypes,
-                    forms = forms_ids,
-                    repdict_items = repdict_items_ids,
-                    repdict_usercats = repdict_usercats_ids,
-                    recs = recdict,
-                )
-                # print 'user_dict', user_dict
-            def _types(row):
-                types = row.types.all()
-                # return _dict(types, lambda field: dict())
-                return utils.db_ids(types)
-            def _reps(reps):
-                return _dict(reps, lambda erep: dict(
-                    name = erep.name,
-                    description = erep.forms_description,
-                    expandable = erep.forms_expandable,
-                    order = erep.forms_order,
-                ))
+            visitids = list(ForceVisit.objects.filter(node__in=go_nodes).values_list('id', flat=True))
             data = dict(
-                user = user_dict,
+                user = payloads.user(go_user, private, _user) if go_user else None,
                 nodes = _dict(go_nodes, lambda node: dict(
                     name = node.name,
                 )),
-                visits = _dict(visits, _visit),
-                allitems = _reps(allitems),
-                allusercats = _reps(allusercats),
-                allformtypes = _dict(allformtypes, lambda ftype: dict(
-                    name = ftype.name,
-                    description = ftype.description,
-                    order = ftype.order,
-                )),
-                allforms = _dict(allforms, lambda form: dict(
-                    name = form.name,
-                    description = form.description,
-                    expandable = form.expandable,
-                    order = form.order,
-                    fields = _dict(form.fields.all(), lambda field: dict(
-                        name = field.name,
-                        description = field.description,
-                        type = field.type,
-                        widget = field.widget,
-                        default = field.default,
-                        required = field.required,
-                        order = field.order,
-                        opts = field.opts(),
-                        types = _types(field),
-                    )),
-                    types = _types(form),
-                )),
+                visits = payloads.visits(visitids, private, _visits),
+                catalog = payloads.catalog(_catalog)[0], # version @ views.catalog.
             )
     # print '_data', config, data
     return data
@@ -151,6 +169,19 @@ def agenda(request):
             break
     return render(request, 'lab/agenda.html', dict(agenda=True, data=json.dumps(data) or 'null'))
 
+def catalog(request):
+    # items, usercats, formtypes & forms, the same for all agendas, cached by the browser / CDN:
+    # for ever if requested by version (?v=, changed @ each change), otherwise revalidated by etag.
+    etag, body = payloads.catalog(_catalog)
+    quoted = '"%s"' % etag
+    if request.META.get('HTTP_IF_NONE_MATCH') == quoted:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = quoted
+    response['Cache-Control'] = 'public, max-age=31536000' if request.GET.get('v') == etag else 'public, max-age=0, must-revalidate'
+    return response
+
 def ajax(request):
     pvars = json.loads(request.POST.get('data'), parse_float=Decimal)
     # print 'ajax', pvars
@@ -211,6 +211,24 @@ LOGIN_REDIRECT_URL = '/member/'
 
 MPTT_ADMIN_LEVEL_INDENT = 20
 
+# shared by all processes (uwsgi workers, run_builders), e.g. the agenda payloads (lab.payloads): python manage.py createcachetable.
+# NO default expiry, every payload is set with its own timeout (e.g. LAB_AGENDA_TIMEOUT), culled beyond MAX_ENTRIES (e.g. 2 per visit).
+CACHES = dict(
+    default = dict(
+        BACKEND = 'lab.cache.DatabaseCache',
+        LOCATION = 'lab_cache',
+        TIMEOUT = None,
+        OPTIONS = dict(
+            MAX_ENTRIES = 100000,
+        ),
+    ),
+)
+
+LAB_BUILDER_BATCH = 500 # VisitBuilder, visits written per bulk_create.
+LAB_BUILDER_STALE = 600 # BuilderJob, seconds without heartbeat (day committed) before a running job is claimable again.
+LAB_NODES_CACHE = 1000 # ForceNode contexts cached per process (lab.nodes), least recently used evicted.
+LAB_AGENDA_TIMEOUT = 3600 # agenda payload sections (lab.payloads), seconds @ the cache backend.
+
 
 SUIT_CONFIG = dict(
     ADMIN_NAME = 'Medical Visits DEMO',
@@ -241,7 +259,7 @@ SUIT_CONFIG = dict(
         dict(label='Site', icon='icon-cog', models=('account.emailconfirmation', 'account.emailaddress', 'sites.site')),
         dict(label='Geos', icon='icon-cog', app='lab', models=('country', 'state', 'city', 'area', 'brick', 'zip')),
         dict(label='OnOff', icon='icon-cog', app='lab', models=('onoffperiod', 'onofftime')),
-        dict(label='Catalogs', icon='icon-cog', app='lab', models=('sys', 'visitbuilder', 'visitcond', 'period', 'weekconfig', 'dayconfig', 'timeconfig')),
+        dict(label='Catalogs', icon='icon-cog', app='lab', models=('sys', 'visitbuilder', 'builderjob', 'visitcond', 'period', 'weekconfig', 'dayconfig', 'timeconfig')),
         dict(label='Cats', icon='icon-cog', app='lab', models=('usercat', 'itemcat', 'loccat', 'placecat', 'formcat', 'periodcat', 'genericcat', 'formtype')),
         dict(label='Lab', icon='icon-cog', app='lab', models=('user', 'userformrec', 'forcenode', 'forcevisit', 'item', 'loc', 'address', 'place', 'form', 'formfield')),
         # dict(label='ALL', icon='icon-cog', app='lab'),
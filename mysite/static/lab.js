@@ -667,5 +667,11 @@ $(function(){
     }
   }
 
-  if (data) { data_set() }
+  if (data) {
+    // catalog (allitems, allusercats, allformtypes, allforms) apart, cached by version.
+    $.getJSON('/lab/catalog', { v: data.catalog }, function(catalog){
+      _(data).extend(catalog)
+      data_set()
+    })
+  }
 })
@@ -75,6 +75,7 @@ sudo -u postgres createdb lab
 sudo -u postgres psql -l
 
 sudo python manage.py migrate # syncdb --noinput
+sudo python manage.py createcachetable
 sudo python manage.py setup_db
 
 